@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the start-up time of the Minion CLI.
+
+Measures how long it takes to import ``minion.cli.main`` in a fresh
+interpreter and checks that modules which are slow to import are not
+imported at start-up. Exits with a non-zero status if either check fails,
+so it can be used to guard against regressions.
+
+Usage: python benchmarks/import_time.py [--runs N] [--max-ms MS]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+#: Modules that should only be imported by the commands that use them
+DEFERRED_MODULES = (
+    'coolname',
+    'dulwich',
+    'jinja2',
+    'multiprocessing',
+    'rackit',
+    'requests',
+    'tabulate',
+    'yaml',
+)
+
+
+def import_time():
+    """
+    Returns the wall-clock time, in seconds, taken to start an interpreter and
+    import the CLI.
+    """
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-c', 'import minion.cli.main'],
+        check = True
+    )
+    return time.perf_counter() - start
+
+
+def baseline_time():
+    """
+    Returns the wall-clock time, in seconds, taken to start an interpreter
+    without importing anything.
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check = True)
+    return time.perf_counter() - start
+
+
+def imported_modules():
+    """
+    Returns the set of deferred modules that are imported with the CLI.
+    """
+    output = subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            'import sys, minion.cli.main; print("\\n".join(sys.modules))'
+        ],
+        check = True,
+        stdout = subprocess.PIPE,
+        universal_newlines = True
+    ).stdout
+    modules = set(output.split())
+    return { m for m in DEFERRED_MODULES if m in modules }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument('--runs', type = int, default = 10)
+    parser.add_argument(
+        '--max-ms',
+        type = float,
+        default = None,
+        help = "Fail if the median import time exceeds this many milliseconds."
+    )
+    args = parser.parse_args()
+
+    baseline = statistics.median(baseline_time() for _ in range(args.runs))
+    total = statistics.median(import_time() for _ in range(args.runs))
+    cost_ms = (total - baseline) * 1000
+    print(f"interpreter start-up: {baseline * 1000:.1f}ms")
+    print(f"import minion.cli.main: {cost_ms:.1f}ms (median of {args.runs})")
+
+    failed = False
+    eager = imported_modules()
+    if eager:
+        print(f"FAIL: imported at start-up: {', '.join(sorted(eager))}")
+        failed = True
+    if args.max_ms is not None and cost_ms > args.max_ms:
+        print(f"FAIL: import time exceeds {args.max_ms:.1f}ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
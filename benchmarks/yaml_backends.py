@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the YAML backends used by Minion.
+
+Compares the pure-Python YAML loader with the backends available from
+:mod:`minion.yamlio`, both for loading a template file and for the per-item
+render-then-parse path of :func:`minion.functions.template`, and with a
+structured template that does not parse anything.
+
+Usage: PYTHONPATH=. python benchmarks/yaml_backends.py [--items N]
+"""
+
+import argparse
+import timeit
+
+import yaml
+
+from minion import yamlio
+from minion.functions import jinja2_environment, template
+
+
+#: Template that renders an issue-like record for each item as JSON, which
+#: is also valid YAML
+TEMPLATE = """
+{
+  "title": {{ input.title | tojson }},
+  "description": {{ input.body | tojson }},
+  "labels": {{ input.labels | tojson }},
+  "number": {{ input.number }},
+  "state": {{ input.state | tojson }}
+}
+"""
+
+
+#: Structured template that produces the same records as TEMPLATE
+STRUCTURED_TEMPLATE = {
+    "title": "{{ input.title }}",
+    "description": "{{ input.body }}",
+    "labels": "{{ input.labels }}",
+    "number": "{{ input.number }}",
+    "state": "{{ input.state }}",
+}
+
+
+def items(count):
+    for i in range(count):
+        yield dict(
+            title = f"Issue {i}",
+            body = f"Description of issue {i}\n" * 5,
+            labels = ['bug', 'help wanted', f"label-{i % 10}"],
+            number = i,
+            state = 'open' if i % 2 else 'closed'
+        )
+
+
+def report(name, seconds, count):
+    print(
+        f"  {name:<16} {seconds * 1000:8.1f}ms  "
+        f"{seconds / count * 1e6:8.1f}us/item"
+    )
+
+
+def best(function):
+    return min(timeit.repeat(function, number = 1, repeat = 3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument('--items', type = int, default = 2000)
+    args = parser.parse_args()
+    data = list(items(args.items))
+
+    print(f"libyaml available: {yamlio.Loader is not yaml.SafeLoader}")
+
+    print(f"Loading a document with {args.items} records:")
+    document = yaml.dump(data, Dumper = yaml.SafeDumper)
+    loaders = [
+        ('pure python', lambda: yaml.load(document, Loader = yaml.SafeLoader)),
+        ('yamlio.load', lambda: yamlio.load(document)),
+    ]
+    for name, function in loaders:
+        report(name, best(function), args.items)
+
+    print(f"Rendering and parsing {args.items} items with template:")
+    compiled = jinja2_environment.from_string(TEMPLATE)
+    functions = [
+        (
+            'pure python',
+            lambda: [
+                yaml.load(compiled.render(input = i), Loader = yaml.SafeLoader)
+                for i in data
+            ]
+        ),
+    ]
+    for backend in ('yaml', 'json'):
+        func = template(TEMPLATE, parser = backend)
+        functions.append(
+            (f"parser={backend}", lambda func = func: [func(i) for i in data])
+        )
+    # The equivalent structured template, which skips YAML entirely
+    func = template(STRUCTURED_TEMPLATE)
+    functions.append(('structured', lambda: [func(i) for i in data]))
+    for name, function in functions:
+        report(name, best(function), args.items)
+
+
+if __name__ == '__main__':
+    main()
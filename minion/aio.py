@@ -0,0 +1,429 @@
+"""
+Asynchronous engine for running Minion plans on an event loop.
+
+When a plan is run using :class:`AsyncEngine`, each function is resolved to
+its asynchronous variant if it has one (see
+:meth:`minion.core.MinionFunction.register_async`). This module provides
+asynchronous variants of ``compose``, ``map``, ``filter`` and ``fork``, so
+that ``map`` and ``filter`` can process several items at once and the
+branches of a concurrent ``fork`` run at the same time.
+
+Functions without an asynchronous variant, including all existing user
+functions and the connector functions, are run unchanged in a thread pool.
+This means that templates do not need to change to use the engine.
+"""
+
+import asyncio
+import collections
+import collections.abc
+import concurrent.futures
+import contextvars
+import functools
+import logging
+import weakref
+
+from .core import import_path, MinionFunction
+from .executors import DEFAULT_BUFFER
+from . import functions, profiling
+
+
+logger = logging.getLogger(__name__)
+
+
+#: The default number of items that each stage processes at once
+DEFAULT_CONCURRENCY = 10
+
+
+# Holds the state for the engine that is running in the current context
+_state = contextvars.ContextVar('state')
+
+
+_State = collections.namedtuple('_State', ['concurrency', 'loop', 'executor'])
+
+
+async def call_blocking(function, *args):
+    """
+    Calls the given blocking function in the engine's thread pool and returns
+    the result.
+    """
+    state = _state.get()
+    context = contextvars.copy_context()
+    return await state.loop.run_in_executor(
+        state.executor,
+        functools.partial(context.run, function, *args)
+    )
+
+
+def _is_async_iterable(obj):
+    return isinstance(obj, collections.abc.AsyncIterable)
+
+
+async def aiterate(items):
+    """
+    Returns an asynchronous iterator over any iterable.
+
+    Iterators, which may block to produce each item (e.g. when fetching pages
+    of results), are advanced in the engine's thread pool.
+    """
+    if _is_async_iterable(items):
+        async for item in items:
+            yield item
+    elif isinstance(items, collections.abc.Iterator):
+        exhausted = object()
+        while True:
+            item = await call_blocking(next, items, exhausted)
+            if item is exhausted:
+                return
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def _anext(iterator):
+    return await iterator.__anext__()
+
+
+class _SyncIterator:
+    """
+    Iterator over an asynchronous iterable for use by synchronous functions
+    running in the engine's thread pool.
+    """
+    def __init__(self, iterable, loop):
+        self._iterator = iterable.__aiter__()
+        self._loop = loop
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        future = asyncio.run_coroutine_threadsafe(
+            _anext(self._iterator),
+            self._loop
+        )
+        try:
+            return future.result()
+        except StopAsyncIteration:
+            raise StopIteration
+
+
+def _to_sync(obj, loop):
+    # Converts any asynchronous iterables in obj to synchronous ones
+    if _is_async_iterable(obj):
+        return _SyncIterator(obj, loop)
+    elif isinstance(obj, tuple):
+        return tuple(_to_sync(o, loop) for o in obj)
+    elif isinstance(obj, list):
+        return [_to_sync(o, loop) for o in obj]
+    else:
+        return obj
+
+
+def to_async(function):
+    """
+    Returns a coroutine function that runs the given synchronous function in
+    the engine's thread pool.
+    """
+    async def func(*args):
+        loop = _state.get().loop
+        return await call_blocking(function, *(_to_sync(a, loop) for a in args))
+    return func
+
+
+def resolve(plan, connectors):
+    """
+    Resolves the given plan, using the asynchronous variant of each function
+    where one exists.
+    """
+    def _resolve(spec):
+        if isinstance(spec, collections.abc.Mapping):
+            if 'functionRef' in spec:
+                function_ref = dict(spec['functionRef'])
+                path = plan._resolve(connectors, function_ref.pop('path'))
+                function = import_path(path)
+                if not isinstance(function, MinionFunction):
+                    raise TypeError(f"'{path}' is not a Minion function")
+                if function.asynchronous is None:
+                    # The arguments of synchronous functions must also be
+                    # synchronous, so resolve the whole thing normally
+                    return to_async(plan._resolve(connectors, spec))
+                func = function.asynchronous(**{
+                    k: _resolve(v) for k, v in function_ref.items()
+                })
+                # Instrument the function as MinionFunction.__call__ does
+                profiler = profiling.current()
+                if profiler is not None:
+                    func = profiler.instrument_async(function.name, func)
+                return func
+            elif 'literalRef' in spec or 'connectorRef' in spec:
+                return plan._resolve(connectors, spec)
+            else:
+                return { k: _resolve(v) for k, v in spec.items() }
+        elif not isinstance(spec, (str, bytes)) and \
+             isinstance(spec, collections.abc.Iterable):
+            return [_resolve(v) for v in spec]
+        else:
+            return spec
+    return _resolve(plan.spec)
+
+
+class AsyncEngine:
+    """
+    Engine that runs plans on an event loop.
+
+    Each ``map`` and ``filter`` processes up to ``concurrency`` items at once,
+    and blocking work is done in a thread pool.
+    """
+    def __init__(self, concurrency = DEFAULT_CONCURRENCY):
+        self.concurrency = concurrency
+
+    async def _main(self, function):
+        # The pool needs more threads than the concurrency, as synchronous
+        # functions that consume the output of asynchronous ones occupy a
+        # thread while they wait for items
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = self.concurrency + 32
+        )
+        token = _state.set(
+            _State(self.concurrency, asyncio.get_running_loop(), executor)
+        )
+        try:
+            result = await function()
+            # If the result is an iterable, ensure it has run to completion
+            if _is_async_iterable(result) or (
+                not isinstance(result, str) and
+                isinstance(result, collections.abc.Iterable)
+            ):
+                async for _ in aiterate(result):
+                    pass
+        finally:
+            _state.reset(token)
+            executor.shutdown(wait = False)
+
+    def run(self, plan, connectors):
+        """
+        Runs the given plan using the given connectors.
+        """
+        asyncio.run(self._main(resolve(plan, connectors)))
+
+
+@functions.compose.register_async
+def _compose(functions):
+    async def func(*args):
+        item = next(iter(args), None)
+        for function in functions:
+            item = await function(item)
+        return item
+    return func
+
+
+async def _imap(function, items):
+    # Applies the function to several items at once, preserving the order
+    window = _state.get().concurrency
+    pending = collections.deque()
+    try:
+        async for item in aiterate(items):
+            pending.append((item, asyncio.ensure_future(function(item))))
+            if len(pending) >= window:
+                item, task = pending.popleft()
+                yield item, await task
+        while pending:
+            item, task = pending.popleft()
+            yield item, await task
+    finally:
+        for _, task in pending:
+            task.cancel()
+
+
+@functions.map.register_async
+def _map(function, batch_size = None):
+    # Items are already processed several at a time, so batches are not used
+    async def results(items):
+        async for _, result in _imap(function, items):
+            yield result
+    async def func(items):
+        return results(items)
+    return func
+
+
+@functions.filter.register_async
+def _filter(predicate, batch_size = None):
+    # Items are already processed several at a time, so batches are not used
+    async def results(items):
+        async for item, keep in _imap(predicate, items):
+            if keep:
+                yield item
+    async def func(items):
+        return results(items)
+    return func
+
+
+class _Prefetcher:
+    # Asynchronous iterator that consumes the given iterable in a task, so
+    # that up to size items are fetched ahead of the consumer, as for
+    # minion.executors.Prefetcher
+    _DONE = object()
+
+    def __init__(self, iterable, size = DEFAULT_BUFFER):
+        self._queue = asyncio.Queue(maxsize = size or 0)
+        self._loop = asyncio.get_running_loop()
+        # The task does not reference the prefetcher, so that it can be
+        # cancelled as soon as the prefetcher is no longer used
+        self._task = asyncio.ensure_future(self._run(self._queue, iterable))
+        self._finished = False
+
+    @classmethod
+    async def _run(cls, queue, iterable):
+        try:
+            async for item in aiterate(iterable):
+                await queue.put((item, None))
+        except asyncio.CancelledError:
+            raise
+        except BaseException as exc:
+            await queue.put((cls._DONE, exc))
+        else:
+            await queue.put((cls._DONE, None))
+
+    @property
+    def stalled(self):
+        """
+        Indicates if fetching is waiting for the consumer.
+        """
+        return self._queue.full()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._finished:
+            raise StopAsyncIteration
+        item, error = await self._queue.get()
+        if item is self._DONE:
+            self._finished = True
+            if error is not None:
+                raise error
+            raise StopAsyncIteration
+        return item
+
+    def close(self):
+        """
+        Stops fetching items.
+        """
+        self._finished = True
+        self._loop.call_soon_threadsafe(self._task.cancel)
+
+    def __del__(self):
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._task.cancel)
+
+
+def _tee(iterable, n, buffer = None, stalled = None):
+    # Returns n independent asynchronous iterators over the iterable. As for
+    # minion.executors.Tee, if buffer is given no iterator can get more than
+    # buffer items ahead of another one, unless that one is stalled.
+    source = aiterate(iterable)
+    buffers = [collections.deque() for _ in range(n)]
+    open_branches = set(range(n))
+    state = dict(exhausted = False, error = None, warned = False)
+    condition = asyncio.Condition()
+    def has_room(index):
+        if buffer is None:
+            return True
+        for other in open_branches:
+            if other == index or len(buffers[other]) < buffer:
+                continue
+            if stalled is not None and stalled(other):
+                if not state['warned']:
+                    logger.warning(
+                        f"Buffering more than {buffer} items as an iterator "
+                        "is not being consumed"
+                    )
+                    state['warned'] = True
+                continue
+            return False
+        return True
+    async def branch(index):
+        own = buffers[index]
+        try:
+            while True:
+                async with condition:
+                    while not own and \
+                          not state['exhausted'] and \
+                          not has_room(index):
+                        # Time out to check for stalls
+                        try:
+                            await asyncio.wait_for(condition.wait(), 0.1)
+                        except asyncio.TimeoutError:
+                            pass
+                    if own:
+                        item = own.popleft()
+                    elif state['error'] is not None:
+                        raise state['error']
+                    elif state['exhausted']:
+                        return
+                    else:
+                        # Fetch the next item on behalf of all the branches
+                        try:
+                            item = await source.__anext__()
+                        except StopAsyncIteration:
+                            state['exhausted'] = True
+                            return
+                        except Exception as exc:
+                            state['exhausted'] = True
+                            state['error'] = exc
+                            raise
+                        finally:
+                            condition.notify_all()
+                        for other in open_branches:
+                            if other != index:
+                                buffers[other].append(item)
+                    condition.notify_all()
+                yield item
+        finally:
+            open_branches.discard(index)
+            own.clear()
+    return [branch(index) for index in range(n)]
+
+
+@functions.fork.register_async
+def _fork(functions, concurrent = False, buffer = DEFAULT_BUFFER):
+    # As for the synchronous fork, the branches only run at the same time if
+    # concurrent is true, in which case their results are fetched ahead
+    async def func(item):
+        prefetchers = [None] * len(functions)
+        def stalled(index):
+            prefetcher = prefetchers[index] and prefetchers[index]()
+            return prefetcher is not None and prefetcher.stalled
+        # Iterators can only be consumed once, so give each branch its own
+        if _is_async_iterable(item) or \
+           isinstance(item, collections.abc.Iterator):
+            items = _tee(
+                item,
+                len(functions),
+                buffer if concurrent else None,
+                stalled
+            )
+        else:
+            items = [item] * len(functions)
+        if not concurrent:
+            return tuple([await f(i) for f, i in zip(functions, items)])
+        async def run(index, function, item):
+            result = await function(item)
+            if _is_async_iterable(result) or \
+               isinstance(result, collections.abc.Iterator):
+                result = _Prefetcher(result, buffer)
+                prefetchers[index] = weakref.ref(result)
+            return result
+        try:
+            results = await asyncio.gather(*(
+                run(index, f, i)
+                for index, (f, i) in enumerate(zip(functions, items))
+            ))
+        except BaseException:
+            for ref in prefetchers:
+                prefetcher = ref and ref()
+                if prefetcher is not None:
+                    prefetcher.close()
+            raise
+        return tuple(results)
+    return func
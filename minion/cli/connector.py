@@ -0,0 +1,72 @@
+"""
+Module containing classes and helpers for working with Minion connectors.
+"""
+
+import collections.abc
+import threading
+
+from ..core import Connector
+
+
+class ConnectorManager(collections.abc.Mapping):
+    """
+    Minion connector manager.
+
+    Behaves as a read-only mapping of connector name to connector. The
+    configuration file is only read once, and each connector is only built
+    the first time it is requested. Connectors are then re-used for the
+    lifetime of the manager, so their HTTP connection pools are too.
+
+    If a connector's configuration enables a ``cache`` without specifying a
+    directory, a directory for the connector inside ``cache_dir`` is used.
+    """
+    def __init__(self, path, cache_dir):
+        self.path = path
+        self.cache_dir = cache_dir
+        self._config = None
+        self._connectors = {}
+        self._lock = threading.RLock()
+
+    @property
+    def config(self):
+        """
+        The connector configurations, indexed by name.
+        """
+        with self._lock:
+            if self._config is None:
+                if self.path.exists():
+                    from .. import yamlio
+                    with self.path.open() as f:
+                        self._config = yamlio.load(f) or {}
+                else:
+                    self._config = {}
+            return self._config
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._connectors:
+                # Copy the config, as Connector.from_config consumes it
+                config = dict(self.config[name])
+                cache = config.get('cache')
+                if cache:
+                    cache = dict(cache) if isinstance(cache, dict) else {}
+                    cache.setdefault('directory', str(self.cache_dir / name))
+                    config['cache'] = cache
+                self._connectors[name] = Connector.from_config(name, config)
+            return self._connectors[name]
+
+    def built(self):
+        """
+        Returns a list of the connectors that have been built so far.
+        """
+        with self._lock:
+            return list(self._connectors.values())
+
+    def __iter__(self):
+        return iter(self.config)
+
+    def __len__(self):
+        return len(self.config)
+
+    def __contains__(self, name):
+        return name in self.config
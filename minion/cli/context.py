@@ -4,12 +4,12 @@ Module containing Minion CLI context and helpers.
 
 import pathlib
 
-import yaml
-
-from ..core import Connector
+from .connector import ConnectorManager
 from .repository import RepositoryManager
 from .template import TemplateManager
 from .job import JobManager
+from .plan import PlanCache
+from .watermark import WatermarkManager
 
 
 class Context:
@@ -18,21 +18,20 @@ class Context:
     """
     def __init__(self, config_dir):
         self.config_dir = pathlib.Path(config_dir).resolve()
+        self.connectors = ConnectorManager(
+            self.config_dir / "connectors.yaml",
+            self.config_dir / "cache" / "http"
+        )
         self.repositories = RepositoryManager(self.config_dir / "templates")
-        self.templates = TemplateManager(self.config_dir / "templates")
+        self.templates = TemplateManager(
+            self.config_dir / "templates",
+            self.config_dir / "cache" / "templates.json"
+        )
         self.jobs = JobManager(self.templates, self.config_dir / "jobs")
+        self.plans = PlanCache(
+            self.templates,
+            self.jobs,
+            self.config_dir / "cache" / "plans"
+        )
+        self.watermarks = WatermarkManager(self.config_dir / "watermarks")
 
-    @property
-    def connectors(self):
-        """
-        Returns a map of the available connectors by name.
-        """
-        path = self.config_dir / "connectors.yaml"
-        if not path.exists():
-            return {}
-        with path.open() as f:
-            connectors = yaml.safe_load(f)
-        return {
-            name: Connector.from_config(name, config)
-            for name, config in connectors.items()
-        }
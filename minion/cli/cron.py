@@ -0,0 +1,139 @@
+"""
+Module containing a parser for cron-style schedules.
+"""
+
+import datetime
+
+
+class CronSyntaxError(ValueError):
+    """
+    Raised when a schedule cannot be parsed.
+    """
+    def __init__(self, expression, reason):
+        super().__init__(f"Invalid schedule '{expression}': {reason}")
+
+
+class CronSchedule:
+    """
+    Schedule defined by a cron expression with five fields: minute, hour, day
+    of month, month and day of week.
+
+    Each field can be ``*``, a number, a range (``1-5``), any of these with a
+    step (``*/15``, ``0-30/10``) or a comma-separated list of them. Months and
+    days of the week can also be given by name (``jan``, ``mon``), and Sunday
+    can be either 0 or 7. As with cron, if both the day of month and day of
+    week are restricted, a day matches if either of them does. A day field
+    that starts with ``*``, e.g. ``*/2``, does not count as restricted, so in
+    that case a day must match both.
+
+    The macros ``@yearly``, ``@annually``, ``@monthly``, ``@weekly``,
+    ``@daily``, ``@midnight`` and ``@hourly`` are also supported.
+    """
+    MACROS = {
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+        '@monthly': '0 0 1 * *',
+        '@weekly': '0 0 * * 0',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@hourly': '0 * * * *',
+    }
+
+    MONTHS = [
+        'jan', 'feb', 'mar', 'apr', 'may', 'jun',
+        'jul', 'aug', 'sep', 'oct', 'nov', 'dec'
+    ]
+    DAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+    def __init__(self, expression):
+        self.expression = expression
+        expression = self.MACROS.get(expression.strip().lower(), expression)
+        fields = expression.split()
+        if len(fields) != 5:
+            raise CronSyntaxError(self.expression, "expected five fields")
+        self.minutes = self._parse(fields[0], 0, 59)
+        self.hours = self._parse(fields[1], 0, 23)
+        self.days = self._parse(fields[2], 1, 31)
+        self.months = self._parse(fields[3], 1, 12, self.MONTHS, 1)
+        # Sunday can be 0 or 7, but is always stored as 0
+        self.weekdays = set(
+            d % 7 for d in self._parse(fields[4], 0, 7, self.DAYS, 0)
+        )
+        # As with cron, a field starting with * (e.g. */2) is not a restriction
+        # for the purposes of combining the day fields
+        self.any_day = fields[2].startswith('*')
+        self.any_weekday = fields[4].startswith('*')
+
+    def _value(self, value, names, offset):
+        if names and value.lower() in names:
+            return names.index(value.lower()) + offset
+        try:
+            return int(value)
+        except ValueError:
+            raise CronSyntaxError(self.expression, f"invalid value '{value}'")
+
+    def _parse(self, field, minimum, maximum, names = None, offset = 0):
+        values = set()
+        for part in field.split(','):
+            range_part, _, step = part.partition('/')
+            if range_part == '*':
+                start, end = minimum, maximum
+            elif '-' in range_part:
+                start, end = (
+                    self._value(v, names, offset)
+                    for v in range_part.split('-', 1)
+                )
+            else:
+                start = self._value(range_part, names, offset)
+                # A value with a step, e.g. 5/10, means from the value up
+                end = maximum if step else start
+            step = self._value(step, None, 0) if step else 1
+            if not (minimum <= start <= end <= maximum) or step < 1:
+                raise CronSyntaxError(
+                    self.expression,
+                    f"'{part}' is out of range"
+                )
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt):
+        # Python weekdays start with Monday = 0, but cron uses Sunday = 0
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, dt):
+        """
+        Returns the first time matching the schedule that is strictly after
+        the given time.
+        """
+        dt = dt.replace(second = 0, microsecond = 0) + \
+            datetime.timedelta(minutes = 1)
+        # Any valid schedule matches within a few years, so this only stops
+        # schedules that can never match, e.g. the 31st of February
+        limit = dt + datetime.timedelta(days = 366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                year, month = divmod(dt.month, 12)
+                dt = dt.replace(
+                    year = dt.year + year,
+                    month = month + 1,
+                    day = 1,
+                    hour = 0,
+                    minute = 0
+                )
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour = 0, minute = 0) + \
+                    datetime.timedelta(days = 1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute = 0) + datetime.timedelta(hours = 1)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes = 1)
+            else:
+                return dt
+        raise CronSyntaxError(self.expression, "schedule never matches")
+
+    def __repr__(self):
+        return f"CronSchedule({self.expression!r})"
@@ -0,0 +1,274 @@
+"""
+Module containing the Minion daemon, which runs jobs on a schedule and accepts
+requests to run jobs over a Unix socket.
+"""
+
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from .cron import CronSchedule
+from .runner import configure_templating, run_job, JobResult
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Status reported for a job that was not run because it was already running
+ALREADY_RUNNING = 'already running'
+#: Status reported for a job that was started without waiting for it
+TRIGGERED = 'triggered'
+
+
+class DaemonAlreadyRunningError(RuntimeError):
+    """
+    Raised when a daemon is already listening on the socket.
+    """
+    def __init__(self, socket_path):
+        super().__init__(f"A daemon is already running at {socket_path}")
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    # Handles a single JSON request per connection and writes one JSON
+    # response per line
+    def _respond(self, **response):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+        self.wfile.flush()
+
+    def handle(self):
+        daemon = self.server.minion_daemon
+        line = self.rfile.readline()
+        if not line:
+            # The client connected without sending a request, e.g. to check
+            # if the daemon is running
+            return
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            self._respond(error = "Invalid request")
+            return
+        command = request.get('command')
+        if command != 'run':
+            self._respond(error = f"Unknown command '{command}'")
+            return
+        jobs = request.get('jobs')
+        if not isinstance(jobs, list) or \
+                not all(isinstance(name, str) for name in jobs):
+            self._respond(error = "Request must contain a list of jobs")
+            return
+        triggered = [(name, daemon.trigger(name)) for name in jobs]
+        for name, future in triggered:
+            if future is None:
+                self._respond(name = name, status = ALREADY_RUNNING)
+            elif request.get('wait'):
+                self._respond(**future.result()._asdict())
+            else:
+                self._respond(name = name, status = TRIGGERED)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    """
+    Long-running process that runs jobs according to their schedules.
+
+    The context is loaded once, so connectors, compiled templates and HTTP
+    caches and connections are re-used between runs. The job files are
+    checked for changes every ``poll_interval`` seconds, and the schedules of
+    any jobs that have changed are re-loaded. Templates are re-loaded
+    automatically when their files change.
+
+    Up to ``parallel`` jobs are run at once. A job is never run while a
+    previous run of the same job is still queued or running.
+
+    Requests to run jobs can be made using :func:`request` with the
+    ``socket_path``.
+    """
+    def __init__(
+        self,
+        ctx,
+        socket_path,
+        parallel = 4,
+        poll_interval = 10,
+        full = False,
+        engine = None
+    ):
+        self.ctx = ctx
+        self.socket_path = socket_path
+        self.poll_interval = poll_interval
+        self.full = full
+        self.engine = engine
+        # Jobs run concurrently, so the shared environment is configured once
+        configure_templating(ctx)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = max(parallel, 1)
+        )
+        # Indexed by job name
+        self._running = {}
+        self._schedules = {}
+        self._next_runs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _run(self, name):
+        start = time.monotonic()
+        try:
+            run_job(self.ctx, name, self.full, self.engine)
+        except Exception:
+            # run_job has already logged the exception
+            status = JobResult.FAILED
+        else:
+            status = JobResult.SUCCEEDED
+        return JobResult(name, status, time.monotonic() - start)
+
+    def trigger(self, name):
+        """
+        Starts running the job with the given name and returns a future for
+        its :class:`~minion.cli.runner.JobResult`, or ``None`` if the job is
+        already running.
+        """
+        with self._lock:
+            future = self._running.get(name)
+            if future is not None and not future.done():
+                return None
+            future = self._executor.submit(self._run, name)
+            self._running[name] = future
+            return future
+
+    def _refresh(self, now):
+        # Re-load the schedules for any jobs whose files have changed
+        names = set(self.ctx.jobs.names())
+        for name in names:
+            try:
+                path = self.ctx.jobs.locate(name)
+                mtime = path.stat().st_mtime_ns
+            except (LookupError, FileNotFoundError):
+                # The job was deleted since the names were listed
+                continue
+            if name in self._schedules and self._schedules[name][0] == mtime:
+                continue
+            try:
+                expression = self.ctx.jobs.spec_from_path(path).get('schedule')
+                schedule = CronSchedule(expression) if expression else None
+                # Fails for schedules that can never match
+                next_run = schedule.next_after(now) if schedule else None
+            except Exception:
+                logger.exception(f"Could not load schedule for job '{name}'")
+                expression = schedule = next_run = None
+            logger.info(
+                f"Loaded job '{name}' with schedule '{expression}'"
+                if schedule else
+                f"Loaded job '{name}' with no schedule"
+            )
+            self._schedules[name] = (mtime, schedule)
+            self._next_runs.pop(name, None)
+            if schedule:
+                self._next_runs[name] = next_run
+        for name in set(self._schedules).difference(names):
+            logger.info(f"Removed job '{name}'")
+            del self._schedules[name]
+            self._next_runs.pop(name, None)
+
+    def _schedule(self):
+        next_refresh = 0
+        while not self._stop.is_set():
+            now = datetime.datetime.now()
+            if time.monotonic() >= next_refresh:
+                self._refresh(now)
+                next_refresh = time.monotonic() + self.poll_interval
+            for name, next_run in list(self._next_runs.items()):
+                if next_run > now:
+                    continue
+                if self.trigger(name) is None:
+                    logger.warning(
+                        f"Skipping scheduled run of job '{name}' as it is "
+                        "still running"
+                    )
+                _, schedule = self._schedules[name]
+                self._next_runs[name] = schedule.next_after(now)
+            # Wait until the next run is due or the jobs should be checked
+            wait = next_refresh - time.monotonic()
+            if self._next_runs:
+                earliest = min(self._next_runs.values())
+                now = datetime.datetime.now()
+                wait = min(wait, (earliest - now).total_seconds())
+            self._stop.wait(max(wait, 0.1))
+
+    def _bind(self):
+        # If there is a socket at the path, check if a daemon is listening
+        if os.path.exists(self.socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(str(self.socket_path))
+                except OSError:
+                    # Stale socket from a daemon that did not exit cleanly
+                    os.unlink(self.socket_path)
+                else:
+                    raise DaemonAlreadyRunningError(self.socket_path)
+        # Only allow the current user to trigger jobs, by creating the socket
+        # without permissions for anyone else so that there is no window in
+        # which they can connect
+        umask = os.umask(0o077)
+        try:
+            server = _Server(str(self.socket_path), _RequestHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, 0o600)
+        server.minion_daemon = self
+        return server
+
+    def serve(self):
+        """
+        Runs the daemon until :meth:`stop` is called.
+        """
+        server = self._bind()
+        thread = threading.Thread(target = server.serve_forever, daemon = True)
+        thread.start()
+        logger.info(f"Listening on {self.socket_path}")
+        try:
+            self._schedule()
+        finally:
+            server.shutdown()
+            server.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+            # Wait for any running jobs to finish
+            self._executor.shutdown(wait = True)
+
+    def stop(self):
+        """
+        Stops the daemon.
+        """
+        self._stop.set()
+
+
+def request(socket_path, jobs, wait = False):
+    """
+    Asks the daemon listening at the given socket to run the given jobs and
+    returns an iterable of responses, one per job. Each response is a
+    dictionary containing the ``name`` and ``status`` of the job, and the
+    ``duration`` if ``wait`` is true, in which case the responses are only
+    returned as the jobs complete.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        request = dict(command = 'run', jobs = list(jobs), wait = wait)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile() as f:
+            for line in f:
+                response = json.loads(line)
+                if 'error' in response:
+                    raise RuntimeError(response['error'])
+                yield response
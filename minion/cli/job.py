@@ -2,11 +2,19 @@
 Command-line interface for managing and running Minion jobs.
 """
 
-import yaml
+import collections
 
 from ..core import Job
 
 
+#: Summary of a job for use in listings
+#: The template is a :class:`~minion.cli.template.TemplateSummary`
+JobSummary = collections.namedtuple(
+    'JobSummary',
+    ['name', 'description', 'template']
+)
+
+
 class JobManager:
     """
     Minion job manager.
@@ -15,48 +23,85 @@ class JobManager:
         self.templates = templates
         self.directory = directory.resolve()
 
-    def from_path(self, path):
+    def spec_from_path(self, path):
+        """
+        Returns the raw specification of the job at the given path.
+        """
+        from .. import yamlio
         with path.open() as f:
-            spec = yaml.safe_load(f)
+            return yamlio.load(f)
+
+    def from_path(self, path):
+        spec = self.spec_from_path(path)
         return Job(
             path.stem,
             spec.get('description', '-'),
             self.templates.find(spec['template']),
-            spec.get('values', {})
+            spec.get('values', {}),
+            spec.get('schedule')
         )
 
+    def names(self):
+        """
+        Returns an iterable of the names of all the available jobs.
+        """
+        for path in sorted(self.directory.glob("*.yaml"), key = lambda p: p.stem):
+            yield path.stem
+
     def all(self):
         """
         Returns an iterable of all the available jobs.
         """
-        for path in sorted(self.directory.glob("*.yaml"), key = lambda p: p.stem):
-            yield self.from_path(path)
+        for name in self.names():
+            yield self.find(name)
 
-    def find(self, name):
+    def summaries(self):
         """
-        Finds and returns a job by name.
+        Returns an iterable of summaries of all the available jobs.
+
+        Unlike :meth:`all`, this does not require the templates to be parsed
+        if they are already in the template index.
+        """
+        for name in self.names():
+            spec = self.spec_from_path(self.locate(name))
+            yield JobSummary(
+                name,
+                spec.get('description', '-'),
+                self.templates.describe(spec['template'])
+            )
+
+    def locate(self, name):
+        """
+        Returns the path to the job with the given name.
         """
         path = self.directory.joinpath(name).with_suffix('.yaml')
         if path.is_file():
-            return self.from_path(path)
+            return path
         raise LookupError("Job {} does not exist".format(repr(name)))
 
-    def save(self, name, description, template, values):
+    def find(self, name):
+        """
+        Finds and returns a job by name.
+        """
+        return self.from_path(self.locate(name))
+
+    def save(self, name, description, template, values, schedule = None):
         """
         Saves the given job in the directory with the highest precedence.
         """
         # Before attempting to write, ensure the directory exists
         self.directory.mkdir(parents = True, exist_ok = True)
         dest = self.directory / "{}.yaml".format(name)
+        spec = dict(
+            description = description or '',
+            template = template.name,
+            values = values
+        )
+        if schedule:
+            spec.update(schedule = schedule)
+        from .. import yamlio
         with dest.open('w') as f:
-            yaml.dump(
-                dict(
-                    description = description or '',
-                    template = template.name,
-                    values = values
-                ),
-                f
-            )
+            yamlio.dump(spec, f)
 
     def delete(self, name):
         """
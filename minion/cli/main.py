@@ -9,12 +9,34 @@ import functools
 import textwrap
 
 import click
-from tabulate import tabulate
-import coolname
-import yaml
 
 from ..core import Parameter
 from . import context
+from .runner import (
+    configure_logging,
+    JobRunner,
+    PROFILE_FORMATS,
+    report_pipeline
+)
+
+
+# The CLI is invoked frequently, e.g. from cron, so modules that are slow to
+# import are only imported by the commands that use them
+
+def tabulate(*args, **kwargs):
+    """
+    Formats a table using ``tabulate``.
+    """
+    from tabulate import tabulate
+    return tabulate(*args, **kwargs)
+
+
+def random_name():
+    """
+    Returns a random name for a job.
+    """
+    import coolname
+    return '_'.join(coolname.generate(2))
 
 
 @click.group()
@@ -35,12 +57,7 @@ def main(ctx, debug, config_dir):
     """
     Minion workflow manager.
     """
-    logging.basicConfig(
-        format = "[%(levelname)s] [%(name)s] %(message)s",
-        level = logging.DEBUG if debug else logging.INFO
-    )
-    # Keep the urllib3 logger at warning only
-    logging.getLogger("urllib3.connectionpool").setLevel(logging.WARNING)
+    configure_logging(logging.DEBUG if debug else logging.INFO)
     ctx.obj = context.Context(config_dir or click.get_app_dir("minion"))
 
 
@@ -57,16 +74,11 @@ def connector_list(ctx):
     """
     List the available connectors.
     """
-    connectors = ctx.connectors
-    if connectors:
+    # Use the configuration so that the connectors do not need to be built
+    config = ctx.connectors.config
+    if config:
         click.echo(tabulate(
-            [
-                (
-                    c.name,
-                    '{}.{}'.format(type(c).__module__, type(c).__qualname__)
-                )
-                for c in sorted(connectors.values(), key = lambda c: c.name)
-            ],
+            [(name, config[name]['path']) for name in sorted(config)],
             headers = ('Name', 'Connector'),
             tablefmt = 'psql'
         ))
@@ -146,6 +158,7 @@ def repo_add(ctx, copy, repo_name, repo_source):
     Currently, REPO_SOURCE can be a local directory or a git repository.
     """
     ctx.repositories.add(repo_name, repo_source, copy)
+    ctx.templates.refresh()
 
 
 @repo_group.command(name = "update")
@@ -159,6 +172,9 @@ def repo_update(ctx, repo_name):
     repositories, it is a no-op.
     """
     ctx.repositories.update(repo_name)
+    # Any plans compiled from the old templates are now stale
+    ctx.plans.clear()
+    ctx.templates.refresh()
 
 
 @repo_group.command(name = "rm")
@@ -173,6 +189,8 @@ def repo_delete(ctx, force, repo_name):
     if not force:
         click.confirm("Are you sure?", abort = True)
     ctx.repositories.delete(repo_name)
+    ctx.plans.clear()
+    ctx.templates.refresh()
 
 
 @main.group(name = "template")
@@ -188,8 +206,7 @@ def template_list(ctx):
     """
     List the available templates.
     """
-    # Get a list of (repo, template) pairs
-    templates = list(ctx.templates.all())
+    templates = ctx.templates.summaries()
     if templates:
         click.echo(tabulate(
             [(t.name, t.description) for t in templates],
@@ -219,11 +236,12 @@ def job_list(ctx, quiet):
     """
     List the available jobs.
     """
-    jobs = list(ctx.jobs.all())
     if quiet:
-        for job in jobs:
-            click.echo(job.name)
-    elif jobs:
+        for name in ctx.jobs.names():
+            click.echo(name)
+        return
+    jobs = list(ctx.jobs.summaries())
+    if jobs:
         click.echo(tabulate(
             [(j.name, j.description or '-', j.template.name) for j in jobs],
             headers = ('Name', 'Description', 'Template'),
@@ -252,7 +270,7 @@ def _merge(destination, values):
     "-n",
     "--name",
     type = str,
-    default = lambda: '_'.join(coolname.generate(2)),
+    default = random_name,
     help = "A name for the job. If not given, a random name will be generated."
 )
 @click.option(
@@ -268,6 +286,14 @@ def _merge(destination, values):
     type = str,
     help = "Parameter values as a YAML string."
 )
+@click.option(
+    "-s",
+    "--schedule",
+    type = str,
+    default = None,
+    help = "Cron expression for when the job should run when Minion is "
+           "running as a daemon, e.g. '*/15 * * * *'."
+)
 @click.option(
     "--input/--no-input",
     "interactive",
@@ -276,10 +302,27 @@ def _merge(destination, values):
 )
 @click.argument("template_name", required = False)
 @click.pass_obj
-def job_create(ctx, name, values_file, values_str, interactive, template_name):
+def job_create(
+    ctx,
+    name,
+    values_file,
+    values_str,
+    schedule,
+    interactive,
+    template_name
+):
     """
     Create a job.
     """
+    import datetime
+    from .. import yamlio
+    from .cron import CronSchedule
+    if schedule:
+        try:
+            # Also rejects schedules that can never run, e.g. '0 0 31 2 *'
+            CronSchedule(schedule).next_after(datetime.datetime.now())
+        except ValueError as exc:
+            raise click.BadParameter(str(exc), param_hint = "'--schedule'")
     # Only allow interactive creation if this is a TTY
     interactive = interactive and sys.stdin.isatty()
     if interactive:
@@ -290,7 +333,7 @@ def job_create(ctx, name, values_file, values_str, interactive, template_name):
     if template_name is None:
         if interactive:
             # Allow the user to pick a template from the list of available ones
-            templates = list(ctx.templates.all())
+            templates = ctx.templates.summaries()
             if not templates:
                 click.secho("No templates available", fg = "red", bold = True)
                 raise SystemExit(1)
@@ -302,7 +345,7 @@ def job_create(ctx, name, values_file, values_str, interactive, template_name):
                 type = click.IntRange(1, len(templates))
             )
             click.echo("")
-            template = templates[template_index - 1]
+            template = ctx.templates.find(templates[template_index - 1].name)
         else:
             raise click.UsageError(
                 "TEMPLATE_NAME is required when in non-interactive mode."
@@ -313,10 +356,10 @@ def job_create(ctx, name, values_file, values_str, interactive, template_name):
     # Values from later files take precedence
     values = {}
     for f in values_file:
-        _merge(values, yaml.safe_load(f))
+        _merge(values, yamlio.load(f))
     # Merge any overrides from the command line
     if values_str:
-        _merge(values, yaml.safe_load(values_str))
+        _merge(values, yamlio.load(values_str))
     if interactive:
         # If running interactively, collect a description
         description = click.prompt('Brief description of job')
@@ -343,7 +386,7 @@ def job_create(ctx, name, values_file, values_str, interactive, template_name):
                 # Try to parse the input as YAML
                 # If it fails for any reason, return the input as-is
                 try:
-                    return yaml.safe_load(input)
+                    return yamlio.load(input)
                 except:
                     return input
             _merge(
@@ -368,10 +411,71 @@ def job_create(ctx, name, values_file, values_str, interactive, template_name):
         for parameter in template.parameters:
             parameter.resolve(values)
     # Save the job
-    ctx.jobs.save(name, description, template, values)
+    ctx.jobs.save(name, description, template, values, schedule)
     click.secho(f"Created job '{name}'", fg = 'green')
 
 
+def _report_metrics(ctx, summary, path):
+    # Reports the HTTP metrics for the connectors that were used
+    connector_metrics = {
+        c.name: c.metrics
+        for c in ctx.connectors.built()
+        if getattr(c, 'metrics', None) is not None
+    }
+    if path:
+        from ..connectors.http import write_prometheus
+        write_prometheus(path, connector_metrics)
+    if not summary:
+        return
+    rows = []
+    for name, session_metrics in sorted(connector_metrics.items()):
+        for endpoint, m in sorted(session_metrics.endpoints.items()):
+            mean = m.latency_sum / m.requests if m.requests else None
+            p95 = m.quantile(0.95)
+            rows.append((
+                name,
+                endpoint,
+                m.requests,
+                m.errors,
+                m.cache_hits,
+                m.pages,
+                m.bytes_received,
+                f"{mean * 1000:.0f}" if mean is not None else '-',
+                f"<={p95 * 1000:.0f}" if p95 is not None else '>max'
+            ))
+    if not rows:
+        click.echo("No HTTP requests made.")
+        return
+    click.echo(tabulate(
+        rows,
+        headers = (
+            'Connector',
+            'Endpoint',
+            'Requests',
+            'Errors',
+            'Cache hits',
+            'Pages',
+            'Bytes in',
+            'Mean (ms)',
+            'p95 (ms)'
+        ),
+        tablefmt = 'psql'
+    ))
+    headroom = [
+        (name, host, remaining, limit)
+        for name, session_metrics in sorted(connector_metrics.items())
+        for host, (remaining, limit) in sorted(
+            session_metrics.rate_limits.items()
+        )
+    ]
+    if headroom:
+        click.echo(tabulate(
+            headroom,
+            headers = ('Connector', 'Host', 'Remaining', 'Limit'),
+            tablefmt = 'psql'
+        ))
+
+
 @job_group.command(name = "run")
 @click.option(
     "-a",
@@ -379,20 +483,243 @@ def job_create(ctx, name, values_file, values_str, interactive, template_name):
     is_flag = True, default = False,
     help = "Execute all jobs. Any specified names are ignored."
 )
+@click.option(
+    "-p",
+    "--parallel",
+    type = click.IntRange(min = 1),
+    default = 1,
+    help = "Number of jobs to execute concurrently (default 1)."
+)
+@click.option(
+    "--executor",
+    type = click.Choice(JobRunner.EXECUTORS),
+    default = 'thread',
+    help = "Execute each job in a thread or a process (default thread)."
+)
+@click.option(
+    "-t",
+    "--timeout",
+    type = click.FloatRange(min = 0),
+    default = None,
+    help = "Maximum time in seconds that each job is allowed to run for. "
+           "Jobs in threads cannot be stopped, so they carry on in the "
+           "background after they time out, with their results discarded. "
+           "Once --parallel of them are still running, the next job waits "
+           "for one to finish. Use --executor process to stop jobs that "
+           "time out."
+)
+@click.option(
+    "--full",
+    is_flag = True, default = False,
+    help = "Ignore the watermarks from previous runs, so that incremental "
+           "jobs process all items."
+)
+@click.option(
+    "--async",
+    "asynchronous",
+    is_flag = True, default = False,
+    help = "Run the jobs using the asynchronous engine."
+)
+@click.option(
+    "--concurrency",
+    type = click.IntRange(min = 1),
+    default = None,
+    help = "The number of items that each map or filter processes at once "
+           "when using the asynchronous engine."
+)
+@click.option(
+    "--buffer",
+    type = click.IntRange(min = 1),
+    default = None,
+    help = "Run each stage of the jobs in its own thread, with up to this "
+           "many items queued between stages, and report the queue depth "
+           "and throughput of each stage."
+)
+@click.option(
+    "--cache-stats",
+    is_flag = True, default = False,
+    help = "Print HTTP and template cache statistics after running. "
+           "Not available with the process executor."
+)
+@click.option(
+    "--metrics",
+    is_flag = True, default = False,
+    help = "Print HTTP metrics for each connector endpoint after running. "
+           "Not available with the process executor."
+)
+@click.option(
+    "--metrics-file",
+    type = click.Path(dir_okay = False, writable = True),
+    default = None,
+    help = "Write HTTP metrics for each connector endpoint to this file in "
+           "the Prometheus text format after running. Not available with the "
+           "process executor."
+)
+@click.option(
+    "--profile",
+    is_flag = True, default = False,
+    help = "Profile each stage of the jobs."
+)
+@click.option(
+    "--profile-format",
+    type = click.Choice(PROFILE_FORMATS),
+    default = 'table',
+    help = "Report the profile as a table (default), or write it to a JSON "
+           "or Chrome trace file named after the job."
+)
+@click.option(
+    "--explain",
+    is_flag = True, default = False,
+    help = "Show the compiled plan for each job, including the fields that "
+           "are requested from each source, instead of running it."
+)
 # Accept any number of names
 @click.argument('names', nargs = -1)
 @click.pass_obj
-def job_run(ctx, all, names):
+def job_run(
+    ctx,
+    all,
+    parallel,
+    executor,
+    timeout,
+    full,
+    asynchronous,
+    concurrency,
+    buffer,
+    cache_stats,
+    metrics,
+    metrics_file,
+    profile,
+    profile_format,
+    explain,
+    names
+):
     """
     Run a job.
+
+    If any job fails or times out, the exit status is non-zero.
     """
     if all:
-        jobs = list(ctx.jobs.all())
+        names = list(ctx.jobs.names())
+    if explain:
+        from .plan import explain as explain_plan
+        for name in names:
+            click.echo(explain_plan(*ctx.plans.compile(name)))
+        return
+    if asynchronous and buffer:
+        raise click.UsageError("--async and --buffer cannot be used together")
+    if asynchronous:
+        from ..aio import AsyncEngine, DEFAULT_CONCURRENCY
+        engine = AsyncEngine(concurrency or DEFAULT_CONCURRENCY)
+    elif buffer:
+        from ..pipeline import PipelineEngine
+        engine = PipelineEngine(buffer, report_pipeline)
     else:
-        jobs = [ctx.jobs.find(name) for name in names]
-    for job in jobs:
-        click.echo(f"Executing job: {job.name}")
-        job.run(ctx.connectors)
+        engine = None
+    runner = JobRunner(
+        ctx,
+        parallel,
+        executor,
+        timeout,
+        full,
+        engine,
+        profile_format if profile else None
+    )
+    failed = [result for result in runner.run(names) if not result.ok]
+    if cache_stats and executor == 'process':
+        # The caches were used in the processes that ran the jobs
+        click.echo(
+            "Cache statistics are not available with the process executor."
+        )
+    elif cache_stats:
+        caches = [
+            (c.name, c.cache)
+            for c in ctx.connectors.built()
+            if getattr(c, 'cache', None) is not None
+        ]
+        if caches:
+            click.echo(tabulate(
+                [
+                    (name, cache.hits, cache.misses)
+                    for name, cache in sorted(caches, key = lambda c: c[0])
+                ],
+                headers = ('Connector', 'Hits', 'Misses'),
+                tablefmt = 'psql'
+            ))
+        else:
+            click.echo("No HTTP caches in use.")
+        from .. import templating
+        stats = templating.stats()
+        click.echo(tabulate(
+            [
+                ('Compiled templates', stats.hits, stats.misses),
+                ('Bytecode', stats.bytecode_hits, stats.bytecode_misses),
+            ],
+            headers = ('Template cache', 'Hits', 'Misses'),
+            tablefmt = 'psql'
+        ))
+    if (metrics or metrics_file) and executor == 'process':
+        # The requests were made in the processes that ran the jobs
+        click.echo("HTTP metrics are not available with the process executor.")
+    elif metrics or metrics_file:
+        _report_metrics(ctx, metrics, metrics_file)
+    if failed:
+        for result in failed:
+            click.secho(
+                f"Job '{result.name}' {result.status} "
+                f"after {result.duration:.1f}s",
+                fg = 'red',
+                bold = True
+            )
+        raise SystemExit(1)
+
+
+@job_group.command(name = "trigger")
+@click.option(
+    "-w",
+    "--wait",
+    is_flag = True, default = False,
+    help = "Wait for the jobs to complete."
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    type = click.Path(dir_okay = False),
+    default = None,
+    help = "The socket that the daemon is listening on."
+)
+@click.argument('names', nargs = -1, required = True)
+@click.pass_obj
+def job_trigger(ctx, wait, socket_path, names):
+    """
+    Run jobs using a running Minion daemon (see 'minion serve').
+
+    If --wait is given and any job fails, the exit status is non-zero.
+    """
+    from .daemon import request
+    from .runner import JobResult
+    failed = False
+    try:
+        for response in request(
+            socket_path or ctx.config_dir / "minion.sock",
+            names,
+            wait
+        ):
+            message = f"Job '{response['name']}' {response['status']}"
+            if 'duration' in response:
+                message += f" after {response['duration']:.1f}s"
+            if response['status'] in (JobResult.SUCCEEDED, 'triggered'):
+                click.echo(message)
+            else:
+                failed = True
+                click.secho(message, fg = 'red', bold = True)
+    except OSError as exc:
+        raise click.ClickException(f"Could not connect to daemon: {exc}")
+    except RuntimeError as exc:
+        # The daemon responded with an error
+        raise click.ClickException(f"Daemon returned an error: {exc}")
+    if failed:
+        raise SystemExit(1)
 
 
 @job_group.command(name = "rm")
@@ -411,3 +738,51 @@ def job_delete(ctx, force, job_name):
     if not force:
         click.confirm("Are you sure?", abort = True)
     ctx.jobs.delete(job_name)
+    ctx.watermarks.delete(job_name)
+
+
+@main.command(name = "serve")
+@click.option(
+    "--socket",
+    "socket_path",
+    type = click.Path(dir_okay = False),
+    default = None,
+    help = "The socket to listen on for requests to run jobs (default "
+           "minion.sock in the configuration directory)."
+)
+@click.option(
+    "-p",
+    "--parallel",
+    type = click.IntRange(min = 1),
+    default = 4,
+    help = "Number of jobs to execute concurrently (default 4)."
+)
+@click.option(
+    "--poll-interval",
+    type = click.FloatRange(min = 1),
+    default = 10,
+    help = "Seconds between checks for changes to the jobs (default 10)."
+)
+@click.pass_obj
+def serve(ctx, socket_path, parallel, poll_interval):
+    """
+    Run jobs according to their schedules.
+
+    Runs until interrupted, keeping connectors, compiled templates and caches
+    between runs. Jobs can also be run using 'minion job trigger'.
+    """
+    import signal
+    from .daemon import Daemon, DaemonAlreadyRunningError
+    daemon = Daemon(
+        ctx,
+        socket_path or ctx.config_dir / "minion.sock",
+        parallel,
+        poll_interval
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.serve()
+    except DaemonAlreadyRunningError as exc:
+        raise click.ClickException(str(exc))
+    except KeyboardInterrupt:
+        pass
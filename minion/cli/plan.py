@@ -0,0 +1,191 @@
+"""
+Module containing classes and helpers for caching compiled Minion plans.
+"""
+
+import collections.abc
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+from ..core import Plan
+
+
+logger = logging.getLogger(__name__)
+
+
+class PlanCache:
+    """
+    On-disk cache of compiled plans.
+
+    Plans are keyed by a hash of the job name, the raw template file and the
+    job's parameter values, so any change to the template or job files
+    (including one made by a repository update) results in a new key.
+
+    When a plan is compiled, the fields that it uses are pushed down to its
+    sources (see :mod:`minion.projection`).
+
+    Only the latest plan for each job is kept, and at most ``max_plans`` plans
+    are kept in total, with the least recently stored removed first, e.g. for
+    jobs that no longer exist.
+    """
+    #: Incremented whenever the format of compiled plans changes
+    FORMAT_VERSION = 2
+
+    #: The default maximum number of plans to keep
+    DEFAULT_MAX_PLANS = 1000
+
+    def __init__(
+        self,
+        templates,
+        jobs,
+        directory,
+        max_plans = DEFAULT_MAX_PLANS
+    ):
+        self.templates = templates
+        self.jobs = jobs
+        self.directory = directory.resolve()
+        self.max_plans = max_plans
+
+    def _key(self, name, template_path, values):
+        digest = hashlib.sha256()
+        digest.update(str(self.FORMAT_VERSION).encode())
+        digest.update(name.encode())
+        digest.update(template_path.read_bytes())
+        digest.update(json.dumps(values, sort_keys = True, default = repr).encode())
+        return digest.hexdigest()
+
+    def _path(self, name, key):
+        # The file name starts with a hash of the job name, so that the other
+        # plans for the job can be found
+        prefix = hashlib.sha256(name.encode()).hexdigest()[:16]
+        return self.directory / f"{prefix}-{key}.json"
+
+    def _prune(self, path):
+        # Removes the other plans for the same job, plans with names from
+        # before they included the job, and the oldest plans if there are too
+        # many
+        prefix = path.name.split('-')[0]
+        paths = []
+        for other in self.directory.glob("*.json"):
+            try:
+                if other != path and (
+                    other.name.startswith(f"{prefix}-") or
+                    '-' not in other.name
+                ):
+                    other.unlink()
+                else:
+                    paths.append((other.stat().st_mtime, other))
+            except FileNotFoundError:
+                # Removed by another process
+                continue
+        paths.sort()
+        for _, other in paths[:max(len(paths) - self.max_plans, 0)]:
+            try:
+                other.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _store(self, path, plan):
+        # Only cache plans that survive a round-trip through JSON unchanged,
+        # e.g. values containing dates or non-string keys do not
+        try:
+            data = json.dumps(plan.spec)
+        except (TypeError, ValueError):
+            data = None
+        if data is None or json.loads(data) != plan.spec:
+            logger.debug(f"Plan for '{plan.name}' cannot be cached")
+            return
+        self.directory.mkdir(parents = True, exist_ok = True)
+        # Write to a temporary file and move it into place, so that concurrent
+        # readers never see a partially written plan
+        temp_path = path.with_suffix(
+            f".{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        temp_path.write_text(data)
+        temp_path.replace(path)
+        self._prune(path)
+
+    def find(self, name):
+        """
+        Returns the compiled plan for the job with the given name, compiling
+        and caching it if required.
+        """
+        spec = self.jobs.spec_from_path(self.jobs.locate(name))
+        template_path = self.templates.locate(spec['template'])
+        path = self._path(
+            name,
+            self._key(name, template_path, spec.get('values', {}))
+        )
+        try:
+            return Plan(name, json.loads(path.read_text()))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            # If the cached plan is corrupt, just compile it again
+            logger.debug(f"Ignoring corrupt cached plan at {path}")
+        plan, _ = self.compile(name)
+        self._store(path, plan)
+        return plan
+
+    def compile(self, name):
+        """
+        Compiles the plan for the job with the given name without using the
+        cache, and returns it with the list of
+        :class:`~minion.projection.Projection`\\ s for its sources.
+        """
+        # Import here as Jinja2 is slow to import
+        from .. import projection
+        return projection.project(self.jobs.find(name).compile())
+
+    def clear(self):
+        """
+        Removes all the cached plans.
+        """
+        if self.directory.exists():
+            shutil.rmtree(self.directory)
+
+
+def _explain(spec, indent, lines):
+    # Adds a line for each function in the spec
+    if isinstance(spec, collections.abc.Mapping):
+        if 'literalRef' in spec:
+            return
+        if 'functionRef' in spec:
+            function_ref = spec['functionRef']
+            line = f"{'  ' * indent}{function_ref.get('path')}"
+            if 'fields' in function_ref:
+                line += f" (fields: {function_ref['fields']})"
+            lines.append(line)
+            indent += 1
+            spec = function_ref
+        for value in spec.values():
+            _explain(value, indent, lines)
+    elif isinstance(spec, list):
+        for value in spec:
+            _explain(value, indent, lines)
+
+
+def explain(plan, projections):
+    """
+    Returns a description of the given plan and projections, as returned by
+    :meth:`PlanCache.compile`, with a line for each function in the plan.
+    """
+    lines = [f"Plan for job: {plan.name}"]
+    _explain(plan.spec, 1, lines)
+    if projections:
+        lines.append("Sources:")
+    for p in projections:
+        if p.fields is None:
+            lines.append(f"  {p.source}: all fields, as {p.reason}")
+        else:
+            fields = p.fields if isinstance(p.fields, str) else ', '.join(p.fields)
+            line = f"  {p.source}: {fields}"
+            if p.view:
+                line += f" using {p.view}"
+            if p.reason:
+                line += f", as {p.reason}"
+            lines.append(line)
+    return '\n'.join(lines)
@@ -7,8 +7,6 @@ import pathlib
 import shutil
 from collections import namedtuple
 
-from dulwich import porcelain
-
 
 class RepositoryError(Exception):
     """
@@ -64,6 +62,8 @@ class RepositoryManager:
         # Now we know we have a path to a directory that is not a symlink
         # To have type 'git', it must be a git repo with a remote called 'origin'
         # The remote URL is what we return as path
+        # dulwich is slow to import, so it is only imported when it is needed
+        from dulwich import porcelain
         try:
             with porcelain.open_repo_closing(path) as r:
                 # Let the KeyError get caught be the outer try
@@ -109,6 +109,7 @@ class RepositoryManager:
                 repo_path.symlink_to(source_path.resolve(), True)
             return
         # Otherwise, try and treat repo_source as a git repository to clone
+        from dulwich import porcelain
         try:
             with open(os.devnull, 'wb') as f:
                 porcelain.clone(repo_source, str(repo_path), errstream = f)
@@ -135,6 +136,7 @@ class RepositoryManager:
         """
         repo = self.find(repo_name)
         if repo.type is 'git':
+            from dulwich import porcelain
             repo_path = self.directory.joinpath(repo.name)
             with open(os.devnull, 'wb') as f:
                 porcelain.pull(
@@ -0,0 +1,332 @@
+"""
+Module containing classes and helpers for running Minion jobs concurrently.
+"""
+
+import collections
+import datetime
+import logging
+import queue
+import threading
+import time
+
+import click
+
+
+logger = logging.getLogger(__name__)
+
+
+# Holds the name of the job being executed by the current thread, if any
+_current_job = threading.local()
+
+
+class JobLogFilter(logging.Filter):
+    """
+    Logging filter that adds a prefix containing the name of the job being
+    executed by the current thread to each record.
+    """
+    def filter(self, record):
+        name = getattr(_current_job, 'name', None)
+        record.job_prefix = f"[{name}] " if name else ""
+        return True
+
+
+def configure_logging(level):
+    """
+    Configures logging for Minion at the given level.
+    """
+    logging.basicConfig(
+        format = "[%(levelname)s] %(job_prefix)s[%(name)s] %(message)s",
+        level = level
+    )
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, JobLogFilter) for f in handler.filters):
+            handler.addFilter(JobLogFilter())
+    # Keep the urllib3 logger at warning only
+    logging.getLogger("urllib3.connectionpool").setLevel(logging.WARNING)
+
+
+#: The formats in which a profile can be reported
+PROFILE_FORMATS = ('table', 'json', 'trace')
+
+
+def report_profile(profiler, name, format):
+    """
+    Reports the profile for the job with the given name in the given format.
+
+    Tables are printed, and JSON and Chrome traces are written to a file in
+    the current directory named after the job.
+    """
+    if format == 'table':
+        click.echo(f"Profile for job: {name}")
+        click.echo(profiler.table())
+    else:
+        if format == 'json':
+            path = f"{name}.profile.json"
+            data = profiler.json()
+        else:
+            path = f"{name}.trace.json"
+            data = profiler.chrome_trace()
+        with open(path, 'w') as f:
+            f.write(data)
+        click.echo(f"Profile for job '{name}' written to {path}")
+
+
+def report_pipeline(name, pipeline):
+    """
+    Prints the queue depth and throughput for each stage of the pipeline for
+    the job with the given name.
+    """
+    # Echo the table in one go so that it is not interleaved with the output
+    # from other jobs
+    click.echo(f"Pipeline for job: {name}\n{pipeline.table()}")
+
+
+def configure_templating(ctx):
+    """
+    Configures the shared Jinja2 environment to cache compiled templates in
+    the configuration directory, so that they are shared between runs.
+
+    The environment is shared by all the jobs in a process, so this must be
+    called once before any jobs are run rather than by each job.
+    """
+    # Import here as Jinja2 is slow to import
+    from .. import templating
+    templating.configure(ctx.config_dir / "cache" / "jinja")
+
+
+class _Outcome:
+    # Decides whether a job that is running in a thread completes or is
+    # abandoned, whichever happens first, so that a job that is reported as
+    # timed out never advances its watermark
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._outcome = None
+
+    def _decide(self, outcome):
+        with self._lock:
+            if self._outcome is None:
+                self._outcome = outcome
+            return self._outcome == outcome
+
+    def complete(self):
+        return self._decide('completed')
+
+    def abandon(self):
+        return self._decide('abandoned')
+
+
+def run_job(
+    ctx,
+    name,
+    full = False,
+    engine = None,
+    profile = None,
+    outcome = None
+):
+    """
+    Runs the job with the given name in the current thread, using the given
+    engine if specified.
+
+    Unless ``full`` is true, the job's watermark is made available to the job
+    so that it can run incrementally. The watermark is only advanced if the
+    job completes successfully, and has not been abandoned by a
+    :class:`JobRunner` because it timed out.
+
+    If ``profile`` is given, the job is profiled and the profile is reported
+    in that format (see :func:`report_profile`), even if the job fails.
+    """
+    _current_job.name = name
+    profiler = None
+    if profile:
+        from ..profiling import Profiler
+        profiler = Profiler(trace = profile == 'trace')
+    try:
+        click.echo(f"Executing job: {name}")
+        plan = ctx.plans.find(name)
+        started = datetime.datetime.now(datetime.timezone.utc)
+        watermark = None if full else ctx.watermarks.get(name)
+        plan.run(ctx.connectors, watermark, engine, profiler)
+        if outcome is None or outcome.complete():
+            ctx.watermarks.set(name, started)
+        else:
+            logger.warning(
+                "Job finished after it timed out, so its watermark was not "
+                "advanced"
+            )
+    except Exception:
+        logger.exception("Job failed")
+        raise
+    finally:
+        if profiler is not None:
+            report_profile(profiler, name, profile)
+        _current_job.name = None
+
+
+def _process_main(config_dir, name, full, engine, profile, level):
+    # Entrypoint for jobs running in a separate process
+    # Import here to avoid a circular import
+    from .context import Context
+    configure_logging(level)
+    ctx = Context(config_dir)
+    configure_templating(ctx)
+    try:
+        run_job(ctx, name, full, engine, profile)
+    except Exception:
+        raise SystemExit(1)
+
+
+class JobResult(collections.namedtuple('JobResult', ['name',
+                                                     'status',
+                                                     'duration'])):
+    """
+    DTO for the result of running a job.
+    """
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    TIMED_OUT = 'timed out'
+
+    @property
+    def ok(self):
+        return self.status == self.SUCCEEDED
+
+
+class JobRunner:
+    """
+    Runs jobs using a pool of workers.
+
+    Each job is executed in its own thread or process depending on the
+    executor. Jobs that exceed the timeout are reported as timed out. Timed
+    out processes are terminated, but timed out threads cannot be stopped so
+    are abandoned: their results, including their watermarks, are discarded,
+    and they will be killed when Minion exits.
+
+    The worker of an abandoned thread moves straight on to the next job, but
+    at most ``max_abandoned`` abandoned threads, by default ``parallel``, can
+    still be running at once. Beyond that, a worker waits for one of them to
+    finish before it runs another job. Jobs that may hang should use the
+    process executor, so that they are stopped when they time out.
+    """
+    EXECUTORS = ('thread', 'process')
+
+    def __init__(
+        self,
+        ctx,
+        parallel = 1,
+        executor = 'thread',
+        timeout = None,
+        full = False,
+        engine = None,
+        profile = None,
+        max_abandoned = None
+    ):
+        if executor not in self.EXECUTORS:
+            raise ValueError(f"Unknown executor '{executor}'")
+        self.ctx = ctx
+        self.full = full
+        self.engine = engine
+        self.profile = profile
+        self.parallel = max(parallel, 1)
+        self.executor = executor
+        self.timeout = timeout
+        self.max_abandoned = (
+            self.parallel
+            if max_abandoned is None
+            else max(max_abandoned, 1)
+        )
+        # Held by each abandoned thread until it finishes
+        self._abandoned = threading.Semaphore(self.max_abandoned)
+        # Processes configure their own environment
+        if executor == 'thread':
+            configure_templating(ctx)
+
+    def _run_in_thread(self, name):
+        errors = []
+        outcome = _Outcome()
+        def target():
+            try:
+                run_job(
+                    self.ctx,
+                    name,
+                    self.full,
+                    self.engine,
+                    self.profile,
+                    outcome
+                )
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                # If the job was abandoned, it no longer holds a place
+                if not outcome.complete():
+                    self._abandoned.release()
+        # Use a daemon thread so that abandoned jobs do not prevent exit
+        thread = threading.Thread(target = target, daemon = True)
+        thread.start()
+        thread.join(self.timeout)
+        if thread.is_alive():
+            if outcome.abandon():
+                if not self._abandoned.acquire(blocking = False):
+                    logger.warning(
+                        f"{self.max_abandoned} jobs that timed out are still "
+                        "running, waiting for one to finish"
+                    )
+                    self._abandoned.acquire()
+                return JobResult.TIMED_OUT
+            # The job completed just as it timed out
+            thread.join()
+        return JobResult.FAILED if errors else JobResult.SUCCEEDED
+
+    def _run_in_process(self, name):
+        import multiprocessing
+        process = multiprocessing.Process(
+            target = _process_main,
+            args = (
+                str(self.ctx.config_dir),
+                name,
+                self.full,
+                self.engine,
+                self.profile,
+                logging.getLogger().getEffectiveLevel()
+            ),
+            daemon = True
+        )
+        process.start()
+        process.join(self.timeout)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+            return JobResult.TIMED_OUT
+        return JobResult.SUCCEEDED if process.exitcode == 0 else JobResult.FAILED
+
+    def _worker(self, names, results):
+        run = (
+            self._run_in_process
+            if self.executor == 'process'
+            else self._run_in_thread
+        )
+        while True:
+            try:
+                name = names.get_nowait()
+            except queue.Empty:
+                return
+            start = time.monotonic()
+            status = run(name)
+            results.put(JobResult(name, status, time.monotonic() - start))
+
+    def run(self, names):
+        """
+        Runs the jobs with the given names and returns an iterable of
+        :class:`JobResult`s in the order that the jobs complete.
+        """
+        names = list(names)
+        pending = queue.Queue()
+        for name in names:
+            pending.put(name)
+        results = queue.Queue()
+        for _ in range(min(self.parallel, len(names))):
+            threading.Thread(
+                target = self._worker,
+                args = (pending, results),
+                daemon = True
+            ).start()
+        for _ in names:
+            yield results.get()
@@ -2,19 +2,181 @@
 Module containing classes and helpers for working with Minion templates.
 """
 
+import collections
+import functools
+import json
+import logging
+import os
 import pathlib
-
-import yaml
+import threading
 
 from ..core import Parameter, Template
 
 
+logger = logging.getLogger(__name__)
+
+
+#: Summary of a template for use in listings, without the spec
+TemplateSummary = collections.namedtuple(
+    'TemplateSummary',
+    ['name', 'description', 'parameters']
+)
+
+
+class TemplateIndex:
+    """
+    Persistent index of template summaries, keyed by template path.
+
+    Each entry records the modification time and size of the file it was
+    built from, so that entries for files that have changed are ignored.
+    """
+    #: Incremented whenever the format of the index changes
+    FORMAT_VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    @property
+    def entries(self):
+        with self._lock:
+            if self._entries is None:
+                self._entries = {}
+                if self.path.exists():
+                    try:
+                        data = json.loads(self.path.read_text())
+                    except ValueError:
+                        # If the index is corrupt, just rebuild it
+                        logger.debug(
+                            f"Ignoring corrupt template index at {self.path}"
+                        )
+                    else:
+                        if data.get('version') == self.FORMAT_VERSION:
+                            self._entries = data['templates']
+            return self._entries
+
+    def get(self, path, stat):
+        """
+        Returns the summary for the template at the given path if it is up to
+        date with the given stat result, otherwise ``None``.
+        """
+        entry = self.entries.get(str(path))
+        if (
+            entry is None or
+            entry['mtime'] != stat.st_mtime_ns or
+            entry['size'] != stat.st_size
+        ):
+            return None
+        return TemplateSummary(
+            entry['name'],
+            entry['description'],
+            set(
+                Parameter(
+                    param['name'],
+                    param['hint'],
+                    param['example'],
+                    param.get('default', Parameter.NO_DEFAULT)
+                )
+                for param in entry['parameters']
+            )
+        )
+
+    def put(self, path, stat, summary):
+        """
+        Records the summary for the template at the given path.
+        """
+        entry = dict(
+            mtime = stat.st_mtime_ns,
+            size = stat.st_size,
+            name = summary.name,
+            description = summary.description,
+            parameters = [
+                dict(
+                    name = param.name,
+                    hint = param.hint,
+                    example = param.example,
+                    **(
+                        dict(default = param.default)
+                        if param.default is not Parameter.NO_DEFAULT
+                        else {}
+                    )
+                )
+                for param in sorted(summary.parameters, key = lambda p: p.name)
+            ]
+        )
+        # Only index templates that survive a round-trip through JSON
+        # unchanged, e.g. defaults containing dates do not
+        try:
+            if json.loads(json.dumps(entry)) != entry:
+                return
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self.entries[str(path)] = entry
+            self._dirty = True
+
+    def retain(self, paths):
+        """
+        Removes the entries for any templates not in the given paths.
+        """
+        paths = set(str(path) for path in paths)
+        with self._lock:
+            for path in set(self.entries).difference(paths):
+                del self.entries[path]
+                self._dirty = True
+
+    def save(self):
+        """
+        Writes the index to disk if it has changed.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(dict(
+                version = self.FORMAT_VERSION,
+                templates = self.entries
+            ))
+            self.path.parent.mkdir(parents = True, exist_ok = True)
+            # Write to a temporary file and move it into place, so that
+            # concurrent readers never see a partially written index
+            temp_path = self.path.with_suffix(
+                f".{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            temp_path.write_text(data)
+            temp_path.replace(self.path)
+            self._dirty = False
+
+
 class TemplateManager:
     """
     Minion template manager.
+
+    If ``index_path`` is given, summaries of the templates are kept in a
+    :class:`TemplateIndex` at that path so that templates only need to be
+    parsed again when they change.
+
+    Templates returned by :meth:`find` are also kept in an in-memory LRU cache
+    of up to ``cache_size`` templates, so that jobs using the same template
+    share a single instance.
     """
-    def __init__(self, directory):
+    #: The default number of templates to keep in memory
+    DEFAULT_CACHE_SIZE = 128
+
+    def __init__(
+        self,
+        directory,
+        index_path = None,
+        cache_size = DEFAULT_CACHE_SIZE
+    ):
         self.directory = directory.resolve()
+        self.index = TemplateIndex(index_path) if index_path else None
+        # The modification time and size are part of the key so that changed
+        # files are loaded again
+        self._load = functools.lru_cache(maxsize = cache_size)(
+            lambda path, mtime, size: self.from_path(path)
+        )
 
     def from_path(self, path):
         try:
@@ -22,8 +184,9 @@ class TemplateManager:
         except ValueError:
             # If the relative path could not be resolved, use the full path
             name = str(path)
+        from .. import yamlio
         with path.open() as f:
-            template_spec = yaml.safe_load(f)
+            template_spec = yamlio.load(f)
         return Template(
             name,
             template_spec.get('description', '-'),
@@ -39,26 +202,84 @@ class TemplateManager:
             template_spec['spec']
         )
 
-    def all(self):
+    def paths(self):
         """
-        Returns an iterable of available templates.
+        Returns a list of the paths of the available templates.
         """
         if not self.directory.exists():
-            return
+            return []
         template_paths = self.directory.glob("*/*.yaml")
-        for path in sorted(template_paths, key = lambda p: str(p)):
+        return sorted(template_paths, key = lambda p: str(p))
+
+    def all(self):
+        """
+        Returns an iterable of available templates.
+        """
+        for path in self.paths():
             yield self.from_path(path)
 
-    def find(self, name):
+    def _summary(self, path):
+        stat = path.stat()
+        summary = self.index.get(path, stat) if self.index else None
+        if summary is None:
+            template = self.from_path(path)
+            summary = TemplateSummary(
+                template.name,
+                template.description,
+                template.parameters
+            )
+            if self.index:
+                self.index.put(path, stat, summary)
+        return summary
+
+    def summaries(self):
         """
-        Finds and returns a template by name.
+        Returns a list of summaries of the available templates.
+
+        Only templates that have changed since they were last indexed are
+        parsed.
+        """
+        paths = self.paths()
+        summaries = [self._summary(path) for path in paths]
+        if self.index:
+            self.index.retain(paths)
+            self.index.save()
+        return summaries
+
+    def describe(self, name):
+        """
+        Returns a summary of the template with the given name.
+        """
+        summary = self._summary(self.locate(name))
+        if self.index:
+            self.index.save()
+        return summary
+
+    def refresh(self):
+        """
+        Brings the index up to date with the available templates, e.g. after
+        a repository has been updated.
+        """
+        self.summaries()
+
+    def locate(self, name):
+        """
+        Returns the path to the template with the given name.
         """
         # First, see if name is an actual file - if it is, use it
         path = pathlib.Path(name)
         if path.is_file():
-            return self.from_path(path)
+            return path
         # If it is not, try and find it in our directory
         path = self.directory / path.with_suffix('.yaml')
         if path.exists():
-            return self.from_path(path)
+            return path
         raise LookupError("Template {} does not exist".format(repr(name)))
+
+    def find(self, name):
+        """
+        Finds and returns a template by name.
+        """
+        path = self.locate(name)
+        stat = path.stat()
+        return self._load(path, stat.st_mtime_ns, stat.st_size)
@@ -0,0 +1,58 @@
+"""
+Module containing classes and helpers for working with Minion job watermarks.
+"""
+
+import datetime
+import json
+import os
+import threading
+
+
+class WatermarkManager:
+    """
+    Minion watermark manager.
+
+    Stores the time at which the last successful run of each job started,
+    with one file per job so that concurrent jobs do not conflict.
+    """
+    def __init__(self, directory):
+        self.directory = directory.resolve()
+
+    def _path(self, name):
+        return self.directory / f"{name}.json"
+
+    def get(self, name):
+        """
+        Returns the watermark for the given job, or ``None`` if there is
+        no watermark.
+        """
+        path = self._path(name)
+        if not path.exists():
+            return None
+        with path.open() as f:
+            value = json.load(f)['watermark']
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z")
+
+    def set(self, name, watermark):
+        """
+        Sets the watermark for the given job.
+        """
+        self.directory.mkdir(parents = True, exist_ok = True)
+        path = self._path(name)
+        temp_path = path.with_suffix(
+            f".{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with temp_path.open('w') as f:
+            json.dump(
+                dict(watermark = watermark.strftime("%Y-%m-%dT%H:%M:%S.%f%z")),
+                f
+            )
+        temp_path.replace(path)
+
+    def delete(self, name):
+        """
+        Removes the watermark for the given job.
+        """
+        path = self._path(name)
+        if path.exists():
+            path.unlink()
@@ -13,10 +13,12 @@ from rackit import (
     RelatedResource
 )
 
-from ..core import Connector, function as minion_function
+from ..core import Connector, function as minion_function, watermark
+from ..projection import Projectable
+from . import http
 
 
-class ResourceManager(BaseResourceManager):
+class ResourceManager(http.PrefetchingManagerMixin, BaseResourceManager):
     def extract_list(self, response):
         next_page = response.links.get('next', {}).get('url')
         return response.json(), next_page
@@ -48,10 +50,22 @@ class Session(Connection, Connector):
     # Register the root resources
     issues = RootResource(Issue)
 
-    def __init__(self, name, api_token):
+    def __init__(
+        self,
+        name,
+        api_token,
+        pool_size = http.DEFAULT_POOL_SIZE,
+        keep_alive = True,
+        prefetch = http.DEFAULT_PREFETCH,
+        cache = None,
+        rate_limit = True
+    ):
         self.name = name
+        self.prefetch = prefetch
         # Build the session to pass to the connection
-        session = requests.Session()
+        session = http.session(pool_size, keep_alive, cache, rate_limit)
+        self.cache = session.cache
+        self.metrics = session.metrics
         session.auth = self.Auth(api_token)
         # Make sure to add the version header
         session.headers.update({ 'Accept': self.GITHUB_ACCEPT })
@@ -59,9 +73,33 @@ class Session(Connection, Connector):
         super().__init__(self.GITHUB_API, session)
 
 
+def _incremental(params, incremental):
+    # If running incrementally, only fetch the items updated since the watermark
+    since = watermark() if incremental else None
+    if since:
+        params = dict(params, since = since.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    return params
+
+
 @minion_function
-def issues(session, **kwargs):
+def issues(session, incremental = False, fields = None, **kwargs):
     """
     Returns a function that returns a list of issues with the given kwargs as URL parameters.
+
+    If ``incremental`` is true, only issues updated since the last successful
+    run of the job are returned.
+
+    If ``fields`` is given, the issues are returned as compact records
+    containing only those fields (see :mod:`minion.records`), which cannot be
+    updated.
     """
-    return lambda *args: session.issues.all(**kwargs)
+    def func(*args):
+        params = _incremental(kwargs, incremental)
+        if fields:
+            return session.issues.all_records(fields, **params)
+        return session.issues.all(**params)
+    return func
+
+
+# Every field of an issue is plain data
+issues.projection = Projectable()
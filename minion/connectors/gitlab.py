@@ -2,6 +2,8 @@
 Minion connector for GitLab.
 """
 
+import functools
+
 import requests
 
 from rackit import (
@@ -13,10 +15,14 @@ from rackit import (
     RelatedResource
 )
 
-from ..core import Connector, function as minion_function
+from ..core import Connector, function as minion_function, watermark
+from ..executors import bounded_map
+from ..projection import Projectable
+from ..records import record_type
+from . import http
 
 
-class ResourceManager(BaseResourceManager):
+class ResourceManager(http.PrefetchingManagerMixin, BaseResourceManager):
     def extract_list(self, response):
         next_page = response.links.get('next', {}).get('url')
         return response.json(), next_page
@@ -82,30 +88,136 @@ class Session(Connection, Connector):
     projects = RootResource(Project)
     issues = RootResource(Issue)
 
-    def __init__(self, name, url, api_token, verify_ssl = True):
+    def __init__(
+        self,
+        name,
+        url,
+        api_token,
+        verify_ssl = True,
+        pool_size = http.DEFAULT_POOL_SIZE,
+        keep_alive = True,
+        prefetch = http.DEFAULT_PREFETCH,
+        cache = None,
+        rate_limit = True
+    ):
         self.name = name
+        self.prefetch = prefetch
         # Build the session to pass to the connection
-        session = requests.Session()
+        session = http.session(pool_size, keep_alive, cache, rate_limit)
+        self.cache = session.cache
+        self.metrics = session.metrics
         session.auth = self.Auth(api_token)
         session.verify = verify_ssl
         # Call the superclass method to initialise the connection
         super().__init__(url, session)
 
 
+def _incremental(params, incremental):
+    # If running incrementally, only fetch the items updated since the watermark
+    since = watermark() if incremental else None
+    if since:
+        params = dict(params, updated_after = since.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    return params
+
+
+#: The fields of the issues returned by the simple view
+SIMPLE_VIEW_FIELDS = frozenset([
+    'id',
+    'iid',
+    'project_id',
+    'title',
+    'description',
+    'state',
+    'created_at',
+    'updated_at',
+    'web_url'
+])
+
+
+def _view(params, fields):
+    # If all the fields are in the simple view, ask for that instead
+    if fields and 'view' not in params and \
+       SIMPLE_VIEW_FIELDS.issuperset(record_type(fields)._fields):
+        params = dict(params, view = 'simple')
+    return params
+
+
+#: Projection support for the issue sources, for which the project and links
+#: are related resources rather than fields
+_ISSUE_PROJECTION = Projectable(
+    ('project', 'links'),
+    { 'view=simple': SIMPLE_VIEW_FIELDS }
+)
+
+
 @minion_function
-def issues(session, **kwargs):
+def issues(session, incremental = False, fields = None, **kwargs):
     """
     Returns a function that returns a list of issues with the given kwargs as URL parameters.
+
+    If ``incremental`` is true, only issues updated since the last successful
+    run of the job are returned.
+
+    If ``fields`` is given, the issues are returned as compact records
+    containing only those fields (see :mod:`minion.records`), which cannot be
+    updated. If all the fields are in the simple view, it is requested.
     """
-    return lambda *args: session.issues.all(**kwargs)
+    def func(*args):
+        params = _incremental(kwargs, incremental)
+        if fields:
+            return session.issues.all_records(fields, **_view(params, fields))
+        return session.issues.all(**params)
+    return func
+
+
+issues.projection = _ISSUE_PROJECTION
 
 
 @minion_function
-def project_issues(session, project):
+def project_issues(session, project, incremental = False, fields = None):
     """
     Returns a function that returns a list of issues for the given project.
+
+    If ``incremental`` is true, only issues updated since the last successful
+    run of the job are returned. If ``fields`` is given, the issues are
+    returned as compact records, as for :func:`issues`.
     """
-    return lambda *args: session.projects.find_by_path_with_namespace(project).issues.all()
+    def func(*args):
+        manager = session.projects.find_by_path_with_namespace(project).issues
+        params = _incremental({}, incremental)
+        if fields:
+            return manager.all_records(fields, **_view(params, fields))
+        return manager.all(**params)
+    return func
+
+
+project_issues.projection = _ISSUE_PROJECTION
+
+
+def _project_finder(session, project):
+    # Returns a function that finds the given project once and remembers it
+    @functools.lru_cache(maxsize = None)
+    def find_project():
+        return session.projects.find_by_path_with_namespace(project)
+    return find_project
+
+
+def _is_noop(issue, patch):
+    # Returns true if applying the patch to the issue would not change it
+    for key, value in patch.items():
+        try:
+            current = getattr(issue, key)
+        except AttributeError:
+            return False
+        # Labels are a list on issues but can be given as a comma-separated
+        # string in the patch
+        if isinstance(current, list) and isinstance(value, str):
+            value = [v.strip() for v in value.split(",") if v.strip()]
+            if sorted(current) != sorted(value):
+                return False
+        elif current != value:
+            return False
+    return True
 
 
 @minion_function
@@ -113,10 +225,45 @@ def create_or_update_issue(session, project):
     """
     Returns a function that creates or updates an issue in the given project.
     """
+    find_project = _project_finder(session, project)
     def func(item):
         issue, patch = item
         if issue:
             return issue._update(patch)
         else:
-            return session.projects.find_by_path_with_namespace(project).issues.create(patch)
+            return find_project().issues.create(patch)
     return func
+
+
+@minion_function
+def create_or_update_issues(
+    session,
+    project,
+    workers = 4,
+    retries = http.DEFAULT_RETRIES
+):
+    """
+    Returns a function that accepts an iterable of ``(issue, patch)`` tuples
+    and returns an iterable of the created or updated issues in the same
+    order, creating the issue in the given project if it is ``None``.
+
+    Patches that would not change the issue are skipped. The remaining
+    requests are made concurrently using up to ``workers`` threads, and each
+    request is retried up to ``retries`` times if it fails with a transient
+    error.
+    """
+    find_project = _project_finder(session, project)
+    def create_or_update(item):
+        issue, patch = item
+        if issue:
+            if _is_noop(issue, patch):
+                return issue
+            return http.retry(issue._update, patch, retries = retries)
+        else:
+            # Creating an issue is not idempotent
+            return http.retry(
+                lambda: find_project().issues.create(patch),
+                retries = retries,
+                idempotent = False
+            )
+    return lambda items: bounded_map(create_or_update, items, workers)
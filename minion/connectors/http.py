@@ -0,0 +1,858 @@
+"""
+HTTP helpers shared by the Minion connectors.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from .. import profiling, records
+from ..executors import bounded_map
+
+
+#: The default maximum number of connections to keep open per host
+DEFAULT_POOL_SIZE = 10
+#: The default number of pages to fetch concurrently when listing resources
+DEFAULT_PREFETCH = 4
+#: The default maximum size of an HTTP cache in bytes
+DEFAULT_CACHE_SIZE = 100 * 1024 * 1024
+#: The default number of times to retry a failed request
+DEFAULT_RETRIES = 2
+
+
+_adapters = {}
+_adapters_lock = threading.Lock()
+
+
+def adapter(pool_size = DEFAULT_POOL_SIZE):
+    """
+    Returns an HTTP adapter with the given pool size.
+
+    Adapters are shared by all the sessions in the process that use the same
+    pool size, so connections to the same host are re-used across connectors.
+    """
+    with _adapters_lock:
+        if pool_size not in _adapters:
+            _adapters[pool_size] = HTTPAdapter(
+                pool_connections = pool_size,
+                pool_maxsize = pool_size
+            )
+        return _adapters[pool_size]
+
+
+class HTTPCache:
+    """
+    On-disk cache of responses to GET requests that is used to make conditional
+    requests.
+
+    Responses are only cached if they have an ``ETag`` or ``Last-Modified``
+    header. When a response is in the cache, the corresponding request is sent
+    with ``If-None-Match`` and ``If-Modified-Since`` headers, and if the server
+    responds with ``304 Not Modified`` the cached response is used instead.
+
+    The total size of the cached responses is limited to ``max_size`` bytes,
+    with the least recently used responses evicted first.
+
+    Attributes:
+        directory: The directory in which responses are cached.
+        max_size: The maximum size of the cache in bytes.
+        hits: The number of responses served from the cache.
+        misses: The number of responses that were not in the cache or had
+            changed.
+    """
+    def __init__(self, directory, max_size = DEFAULT_CACHE_SIZE):
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _key(self, request):
+        # Responses can depend on who is asking and which representation they
+        # want as well as the URL
+        digest = hashlib.sha256()
+        for part in (
+            request.method,
+            request.url,
+            request.headers.get('Authorization', ''),
+            request.headers.get('Accept', '')
+        ):
+            digest.update(part.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _path(self, key):
+        # Each entry is a single file holding a line of JSON metadata followed
+        # by the body, so that it can be replaced atomically
+        return self.directory / f"{key}.response"
+
+    def _total_size(self):
+        # Must be called with the lock held
+        if self._size is None:
+            self._size = sum(
+                p.stat().st_size for p in self.directory.glob("*.response")
+            )
+        return self._size
+
+    def _evict(self):
+        # Must be called with the lock held
+        # Evict the least recently used entries until the cache is under size
+        paths = sorted(
+            self.directory.glob("*.response"),
+            key = lambda p: p.stat().st_mtime
+        )
+        for path in paths:
+            if self._size <= self.max_size:
+                break
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            self._size -= size
+
+    def get(self, request):
+        """
+        Returns the cached metadata and body for the given request, or
+        ``None`` if there is no cached response.
+        """
+        path = self._path(self._key(request))
+        try:
+            with path.open('rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        # Mark the entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return meta, body
+
+    def put(self, request, response):
+        """
+        Caches the given response to the given request if it has validators.
+        """
+        if 'ETag' not in response.headers and \
+           'Last-Modified' not in response.headers:
+            return
+        # JSON without indentation never contains a newline
+        meta = json.dumps({
+            'headers': dict(response.headers),
+            'encoding': response.encoding,
+        })
+        data = meta.encode() + b'\n' + response.content
+        path = self._path(self._key(request))
+        with self._lock:
+            self.directory.mkdir(parents = True, exist_ok = True)
+            size = self._total_size()
+            if path.exists():
+                size -= path.stat().st_size
+            # Write the entry atomically so that readers, including those in
+            # other processes, never see a partially written entry or the
+            # metadata of one response with the body of another
+            temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            temp_path.write_bytes(data)
+            temp_path.replace(path)
+            self._size = size + len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def record(self, hit):
+        """
+        Records a cache hit or miss.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def clear(self):
+        """
+        Removes all the cached responses.
+        """
+        with self._lock:
+            for path in self.directory.glob("*"):
+                path.unlink()
+            self._size = 0
+
+
+class RateLimitExceeded(requests.exceptions.RequestException):
+    """
+    Raised when a request cannot be made because the rate limit for the
+    service would not allow it for longer than the session is prepared to
+    wait.
+    """
+
+
+class RateLimiter:
+    """
+    Token bucket that keeps requests to a service within its rate limit.
+
+    The bucket holds the number of requests remaining in the current rate limit
+    window, as learned from the rate limit headers of responses from the
+    service (``X-RateLimit-*`` for GitHub and ``RateLimit-*`` for GitLab), less
+    a reserve for requests that are already in flight. Each request takes a
+    token and the bucket is refilled when the window resets.
+
+    Once fewer than ``pace_below`` (a fraction of the limit) requests remain,
+    the remaining requests are spread evenly over the rest of the window
+    rather than being used up immediately. If the bucket is empty, or the
+    service rejects a request because a limit has been hit, all requests are
+    held back until the window resets or the time given by ``Retry-After``.
+
+    Until a service reports its rate limit, requests are not throttled.
+    """
+    def __init__(self, reserve = 10, pace_below = 0.1):
+        self.reserve = reserve
+        self.pace_below = pace_below
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.last_request = 0
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+
+    def _delay(self, now):
+        # Returns the time to wait before the next request can be made
+        # Must be called with the lock held
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.remaining is None:
+            return 0
+        if now >= self.reset_at:
+            # The window has reset, so we don't know the budget until the
+            # next response
+            self.remaining = None
+            return 0
+        available = self.remaining - self.reserve
+        if available < 1:
+            return self.reset_at - now
+        if self.limit and available < self.limit * self.pace_below:
+            interval = (self.reset_at - now) / available
+            return max(self.last_request + interval - now, 0)
+        return 0
+
+    def acquire(self, max_wait = None):
+        """
+        Waits until a request can be made, then takes a token and returns
+        ``True``.
+
+        If ``max_wait`` is given and a request cannot be made within that many
+        seconds, returns ``False`` immediately without waiting.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = self._delay(now)
+                if delay <= 0:
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    self.last_request = now
+                    return True
+                if max_wait is not None and delay > max_wait:
+                    return False
+            # Add some jitter so that waiting threads do not wake together
+            time.sleep(delay * random.uniform(1, 1.2))
+
+    def _header(self, response, *names):
+        for name in names:
+            try:
+                return float(response.headers[name])
+            except (KeyError, ValueError):
+                pass
+        return None
+
+    def update(self, response):
+        """
+        Updates the bucket using the headers of the given response.
+
+        Returns the number of seconds to wait before retrying the request if
+        it was rejected due to rate limiting, or ``None`` otherwise.
+        """
+        limit = self._header(response, 'X-RateLimit-Limit', 'RateLimit-Limit')
+        remaining = self._header(
+            response,
+            'X-RateLimit-Remaining',
+            'RateLimit-Remaining'
+        )
+        reset = self._header(response, 'X-RateLimit-Reset', 'RateLimit-Reset')
+        retry_after = self._header(response, 'Retry-After')
+        # The reset headers are epoch times, but we work with monotonic times
+        until_reset = max(reset - time.time(), 0) if reset is not None else None
+        with self._lock:
+            now = time.monotonic()
+            if remaining is not None and until_reset is not None:
+                self.limit = limit
+                self.remaining = remaining
+                self.reset_at = now + until_reset
+            rejected = response.status_code == 429 or (
+                response.status_code == 403 and
+                (retry_after is not None or remaining == 0)
+            )
+            if not rejected:
+                return None
+            if retry_after is not None:
+                delay = retry_after
+            elif until_reset is not None:
+                delay = until_reset
+            else:
+                delay = 60
+            self.blocked_until = max(self.blocked_until, now + delay)
+            return delay
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def rate_limiter(request, **kwargs):
+    """
+    Returns the :class:`RateLimiter` for the service and credentials used by
+    the given request. Limiters are shared by all the sessions in the process,
+    so concurrent jobs share the budget.
+    """
+    key = (
+        urllib.parse.urlsplit(request.url).netloc,
+        hashlib.sha256(
+            request.headers.get('Authorization', '').encode()
+        ).hexdigest()
+    )
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(**kwargs)
+        return _limiters[key]
+
+
+#: The default upper bounds, in seconds, of the buckets for latency histograms
+DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def endpoint(method, url):
+    """
+    Returns a name for the endpoint of a request to the given URL, in which
+    any numeric path segments (i.e. IDs) are replaced with ``{id}``.
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = '/'.join(
+        '{id}' if segment.isdigit() else segment
+        for segment in parts.path.split('/')
+    )
+    return f"{method} {parts.netloc}{path}"
+
+
+class EndpointMetrics:
+    """
+    Metrics for requests to a single endpoint.
+
+    ``latency_buckets`` holds the number of requests that took at most the
+    corresponding bound in ``buckets``, with a final bucket for all requests.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.requests = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.pages = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (len(buckets) + 1)
+
+    def observe(self, latency):
+        self.latency_sum += latency
+        for i, bound in enumerate(self.buckets):
+            if latency <= bound:
+                self.latency_buckets[i] += 1
+        self.latency_buckets[-1] += 1
+
+    def quantile(self, q):
+        """
+        Returns an upper bound for the given quantile of the latency, or
+        ``None`` if the quantile exceeds the largest bucket.
+        """
+        total = self.latency_buckets[-1]
+        for bound, count in zip(self.buckets, self.latency_buckets):
+            if count >= q * total:
+                return bound
+        return None
+
+
+class HTTPMetrics:
+    """
+    Thread-safe collection of metrics for the requests made by a session,
+    indexed by endpoint (see :func:`endpoint`).
+
+    The rate limit headroom reported by each host is also recorded as a
+    ``(remaining, limit)`` tuple.
+    """
+    #: Prometheus metric names for the counters of each endpoint
+    COUNTERS = (
+        ('requests_total', 'requests'),
+        ('errors_total', 'errors'),
+        ('cache_hits_total', 'cache_hits'),
+        ('pages_total', 'pages'),
+        ('sent_bytes_total', 'bytes_sent'),
+        ('received_bytes_total', 'bytes_received'),
+    )
+
+    def __init__(self, buckets = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.endpoints = {}
+        self.rate_limits = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, request):
+        # Must be called with the lock held
+        name = endpoint(request.method, request.url)
+        if name not in self.endpoints:
+            self.endpoints[name] = EndpointMetrics(self.buckets)
+        return self.endpoints[name]
+
+    def record(self, request, response, latency):
+        """
+        Records a request and its response, or ``None`` if the request
+        failed, which took ``latency`` seconds.
+        """
+        body = request.body or b''
+        sent = len(body.encode() if isinstance(body, str) else body)
+        if response is not None:
+            # Avoid reading the body of streamed responses
+            received = response.headers.get('Content-Length')
+            if received is None and response._content_consumed:
+                received = len(response.content or b'')
+            remaining = response.headers.get(
+                'X-RateLimit-Remaining',
+                response.headers.get('RateLimit-Remaining')
+            )
+            limit = response.headers.get(
+                'X-RateLimit-Limit',
+                response.headers.get('RateLimit-Limit')
+            )
+        with self._lock:
+            metrics = self._endpoint(request)
+            metrics.requests += 1
+            metrics.bytes_sent += sent
+            metrics.observe(latency)
+            if response is None or response.status_code >= 400:
+                metrics.errors += 1
+            if response is not None:
+                metrics.bytes_received += int(received or 0)
+                if remaining is not None and limit is not None:
+                    host = urllib.parse.urlsplit(request.url).netloc
+                    self.rate_limits[host] = (int(remaining), int(limit))
+
+    def record_cache_hit(self, request):
+        """
+        Records that the response to a request was served from the cache.
+        """
+        with self._lock:
+            self._endpoint(request).cache_hits += 1
+
+    def record_page(self, response):
+        """
+        Records that the given response was a page of a list.
+        """
+        with self._lock:
+            self._endpoint(response.request).pages += 1
+
+    def samples(self, **labels):
+        """
+        Returns the metrics as a list of ``(family, line)`` pairs, where
+        ``line`` is a sample in the Prometheus text format with the given
+        labels added, and ``family`` is the name of the metric that it belongs
+        to, without the ``minion_http_`` prefix or the suffix of a histogram.
+
+        The ``# TYPE`` lines are not included. As all the samples of a metric
+        must follow its ``# TYPE`` line, the samples of several sessions must
+        be grouped by family to be combined (see :func:`write_prometheus`).
+        """
+        def sample(family, name, value, **extra):
+            all_labels = ','.join(
+                '{}="{}"'.format(
+                    k,
+                    str(v).replace('\\', '\\\\').replace('"', '\\"')
+                )
+                for k, v in dict(labels, **extra).items()
+            )
+            return family, f"minion_http_{name}{{{all_labels}}} {value}"
+        samples = []
+        histogram = 'request_duration_seconds'
+        with self._lock:
+            for name, metrics in sorted(self.endpoints.items()):
+                for metric, attr in self.COUNTERS:
+                    samples.append(sample(
+                        metric,
+                        metric,
+                        getattr(metrics, attr),
+                        endpoint = name
+                    ))
+                bounds = [str(b) for b in self.buckets] + ['+Inf']
+                for bound, count in zip(bounds, metrics.latency_buckets):
+                    samples.append(sample(
+                        histogram,
+                        f'{histogram}_bucket',
+                        count,
+                        endpoint = name,
+                        le = bound
+                    ))
+                samples.extend([
+                    sample(
+                        histogram,
+                        f'{histogram}_sum',
+                        metrics.latency_sum,
+                        endpoint = name
+                    ),
+                    sample(
+                        histogram,
+                        f'{histogram}_count',
+                        metrics.requests,
+                        endpoint = name
+                    ),
+                ])
+            for host, (remaining, limit) in sorted(self.rate_limits.items()):
+                samples.extend([
+                    sample(
+                        'rate_limit_remaining',
+                        'rate_limit_remaining',
+                        remaining,
+                        host = host
+                    ),
+                    sample(
+                        'rate_limit_limit',
+                        'rate_limit_limit',
+                        limit,
+                        host = host
+                    ),
+                ])
+        return samples
+
+
+def write_prometheus(path, metrics):
+    """
+    Writes the given :class:`HTTPMetrics`, indexed by connector name, to the
+    given path in the Prometheus text format, e.g. for the node exporter's
+    textfile collector. The file is replaced atomically.
+    """
+    types = [(metric, 'counter') for metric, _ in HTTPMetrics.COUNTERS] + [
+        ('request_duration_seconds', 'histogram'),
+        ('rate_limit_remaining', 'gauge'),
+        ('rate_limit_limit', 'gauge'),
+    ]
+    # All the samples of a metric must follow its TYPE line, so the samples
+    # from all the connectors are grouped by metric
+    families = { metric: [] for metric, _ in types }
+    for name, session_metrics in sorted(metrics.items()):
+        for family, line in session_metrics.samples(connector = name):
+            families[family].append(line)
+    lines = []
+    for metric, type in types:
+        lines.append(f"# TYPE minion_http_{metric} {type}")
+        lines.extend(families[metric])
+    path = pathlib.Path(path)
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    temp_path.write_text('\n'.join(lines) + '\n')
+    temp_path.replace(path)
+
+
+class Session(requests.Session):
+    """
+    ``requests.Session`` that respects the rate limits of the services it talks
+    to and can use an :class:`HTTPCache` to make conditional GET requests.
+
+    Requests that are rejected due to rate limiting are retried up to
+    ``retries`` times, provided the required wait is less than ``max_wait``
+    seconds. If the rate limit would hold a request back for longer than
+    ``max_wait`` seconds, :class:`RateLimitExceeded` is raised instead.
+    """
+    def __init__(self, cache = None, rate_limit = None):
+        super().__init__()
+        self.cache = cache
+        self.metrics = HTTPMetrics()
+        if rate_limit is True:
+            rate_limit = {}
+        # Note that an empty dict enables rate limiting with the defaults
+        self.rate_limit = None if rate_limit in (None, False) else dict(rate_limit)
+        if self.rate_limit is not None:
+            self.rate_limit_retries = self.rate_limit.pop('retries', 3)
+            self.rate_limit_max_wait = self.rate_limit.pop('max_wait', 300)
+
+    def _cached_response(self, request, response, meta, body):
+        # Build a response from the cached data, with any headers from the
+        # 304 response, e.g. rate limit headers, taking precedence
+        cached = requests.Response()
+        cached.status_code = 200
+        cached.reason = 'OK'
+        cached.headers = CaseInsensitiveDict(meta['headers'])
+        cached.headers.update(response.headers)
+        cached.encoding = meta['encoding']
+        cached._content = body
+        cached.url = request.url
+        cached.request = request
+        cached.elapsed = response.elapsed
+        cached.connection = response.connection
+        cached.from_cache = True
+        return cached
+
+    def _send_measured(self, request, **kwargs):
+        start = time.perf_counter()
+        response = None
+        try:
+            response = super().send(request, **kwargs)
+            return response
+        finally:
+            self.metrics.record(
+                request,
+                response,
+                time.perf_counter() - start
+            )
+
+    def _send_conditional(self, request, **kwargs):
+        if self.cache is None or request.method != 'GET':
+            return self._send_measured(request, **kwargs)
+        cached = self.cache.get(request)
+        if cached:
+            meta, body = cached
+            # The headers are stored with the casing the server sent
+            headers = CaseInsensitiveDict(meta['headers'])
+            etag = headers.get('ETag')
+            if etag:
+                request.headers['If-None-Match'] = etag
+            last_modified = headers.get('Last-Modified')
+            if last_modified:
+                request.headers['If-Modified-Since'] = last_modified
+        response = self._send_measured(request, **kwargs)
+        if cached and response.status_code == 304:
+            self.cache.record(True)
+            self.metrics.record_cache_hit(request)
+            return self._cached_response(request, response, meta, body)
+        self.cache.record(False)
+        if response.status_code == 200:
+            self.cache.put(request, response)
+        return response
+
+    def send(self, request, **kwargs):
+        profiler = profiling.current()
+        if profiler is None:
+            return self._send_limited(request, **kwargs)
+        # Record the time spent waiting for the response, including any
+        # waits imposed by the rate limiter, as I/O
+        start = time.perf_counter()
+        try:
+            return self._send_limited(request, **kwargs)
+        finally:
+            netloc = urllib.parse.urlsplit(request.url).netloc
+            profiler.record_io(f"{request.method} {netloc}", start)
+
+    def _send_limited(self, request, **kwargs):
+        if self.rate_limit is None:
+            return self._send_conditional(request, **kwargs)
+        limiter = rate_limiter(request, **self.rate_limit)
+        attempt = 0
+        while True:
+            if not limiter.acquire(self.rate_limit_max_wait):
+                raise RateLimitExceeded(
+                    "Rate limit exceeded for "
+                    f"{urllib.parse.urlsplit(request.url).netloc}",
+                    request = request
+                )
+            response = self._send_conditional(request, **kwargs)
+            delay = limiter.update(response)
+            if delay is None or \
+               attempt >= self.rate_limit_retries or \
+               delay > self.rate_limit_max_wait:
+                return response
+            # The limiter will hold us back until the retry is allowed
+            response.close()
+            attempt += 1
+
+
+def session(
+    pool_size = DEFAULT_POOL_SIZE,
+    keep_alive = True,
+    cache = None,
+    rate_limit = True
+):
+    """
+    Returns a new :class:`Session` that uses the shared adapter for the given
+    pool size.
+
+    If ``keep_alive`` is false, connections are closed after each request.
+
+    If ``cache`` is given, it should be a dictionary of keyword arguments for
+    an :class:`HTTPCache` that the session will use.
+
+    ``rate_limit`` can be false to disable rate limiting, or a dictionary
+    containing ``retries`` and ``max_wait`` for the session and keyword
+    arguments for the :class:`RateLimiter`.
+    """
+    session = Session(HTTPCache(**cache) if cache else None, rate_limit)
+    shared = adapter(pool_size)
+    session.mount('https://', shared)
+    session.mount('http://', shared)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def _is_transient(exc, idempotent):
+    # Failures that are guaranteed to have happened before the request reached
+    # the server, and rate limiting, are always worth retrying
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    status_code = getattr(exc, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(exc, 'response', None), 'status_code', None)
+    if status_code == 429:
+        return True
+    # Other connection problems and server errors may have happened after the
+    # request was processed, so are only worth retrying for idempotent requests
+    if not idempotent:
+        return False
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return status_code is not None and status_code >= 500
+
+
+def retry(
+    function,
+    *args,
+    retries = DEFAULT_RETRIES,
+    backoff = 1,
+    idempotent = True,
+    **kwargs
+):
+    """
+    Calls the given function with the given arguments, retrying up to
+    ``retries`` times if it fails with a transient error, e.g. a connection
+    error or a 5xx response.
+
+    If ``idempotent`` is false, the function is only retried when it is
+    certain that repeating it is safe, i.e. when the connection could not be
+    made or the request was rejected due to rate limiting.
+
+    The delay between attempts grows exponentially from ``backoff`` seconds,
+    with some jitter.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return function(*args, **kwargs)
+        except Exception as exc:
+            if attempt == retries or not _is_transient(exc, idempotent):
+                raise
+        time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def _page_number(url):
+    # Returns the value of the page parameter in the URL, if present
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    try:
+        return int(query['page'][0])
+    except (KeyError, ValueError):
+        return None
+
+
+def _with_page_number(url, page):
+    # Returns the URL with the page parameter replaced
+    parts = urllib.parse.urlsplit(url)
+    query = [
+        (k, v)
+        for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values = True)
+        if k != 'page'
+    ]
+    query.append(('page', str(page)))
+    return urllib.parse.urlunsplit(
+        parts._replace(query = urllib.parse.urlencode(query))
+    )
+
+
+def page_urls(response):
+    """
+    Returns a list of the URLs for all the pages following the given response
+    of a paginated list, or ``None`` if they cannot be computed.
+
+    The URLs can only be computed when the pagination is page-number based
+    and the response says how many pages there are, either using a ``last``
+    link or the ``X-Total-Pages`` header.
+    """
+    next_url = response.links.get('next', {}).get('url')
+    if not next_url:
+        return []
+    next_page = _page_number(next_url)
+    if next_page is None:
+        return None
+    if 'X-Total-Pages' in response.headers:
+        try:
+            last_page = int(response.headers['X-Total-Pages'])
+        except ValueError:
+            last_page = None
+    else:
+        last_page = _page_number(response.links.get('last', {}).get('url', ''))
+    if last_page is None:
+        return None
+    return [_with_page_number(next_url, p) for p in range(next_page, last_page + 1)]
+
+
+class PrefetchingManagerMixin:
+    """
+    Mixin for resource managers that fetches the pages of a list concurrently.
+
+    After the first page has been fetched, the URLs for the remaining pages
+    are computed from the pagination metadata and up to ``prefetch`` of them
+    are fetched at once. Items are still returned lazily and in order. If the
+    URLs cannot be computed, or prefetching is disabled on the connection,
+    the ``next`` links are followed one page at a time.
+    """
+    def all_data(self, **params):
+        """
+        Returns an iterable of the raw data for all the resources.
+        """
+        response = self.connection.api_get(
+            self.prepare_url(),
+            params = self.prepare_params(params)
+        )
+        data, next_url = self.extract_list(response)
+        metrics = getattr(self.connection, 'metrics', None)
+        if metrics is not None:
+            metrics.record_page(response)
+        prefetch = getattr(self.connection, 'prefetch', DEFAULT_PREFETCH)
+        urls = page_urls(response) if next_url and prefetch > 1 else None
+        yield from data
+        if urls is not None:
+            responses = bounded_map(self.connection.api_get, urls, prefetch)
+            for response in responses:
+                if metrics is not None:
+                    metrics.record_page(response)
+                data, _ = self.extract_list(response)
+                yield from data
+        else:
+            while next_url:
+                response = self.connection.api_get(next_url)
+                if metrics is not None:
+                    metrics.record_page(response)
+                data, next_url = self.extract_list(response)
+                yield from data
+
+    def all(self, **params):
+        return (self.make_instance(data) for data in self.all_data(**params))
+
+    def all_records(self, fields, **params):
+        """
+        Returns an iterable of :class:`~minion.records.Record`\\ s containing
+        only the given fields for all the resources, which use much less
+        memory than resources but cannot be updated.
+        """
+        record = records.record_type(fields)
+        return (record.from_data(data) for data in self.all_data(**params))
@@ -4,8 +4,12 @@ Utilities for building and running Minion jobs.
 
 import collections
 import collections.abc
+import contextvars
+import functools
 import importlib
 
+from . import profiling
+
 
 class MinionFunction:
     """
@@ -20,12 +24,44 @@ class MinionFunction:
     The returned function should take a single argument representing the
     incoming item. This may be called many times. A function for which the
     single argument is optional is referred to as a "source".
+
+    A Minion function can also have an asynchronous variant, which is used by
+    the asynchronous engine (see :mod:`minion.aio`). It takes the same
+    configuration parameters but returns a coroutine function.
+
+    If a profiler is active (see :mod:`minion.profiling`), the returned
+    function is instrumented as a stage of the pipeline.
+
+    A source can declare that it accepts a ``fields`` parameter by setting
+    ``projection`` to a :class:`minion.projection.Projectable`, in which case
+    the fields that a plan uses are passed to it (see :mod:`minion.projection`).
     """
     def __init__(self, wrapped):
         self._wrapped = wrapped
+        self.asynchronous = None
+        self.projection = None
+
+    @property
+    def name(self):
+        """
+        The qualified name of the wrapped callable.
+        """
+        return f"{self._wrapped.__module__}.{self._wrapped.__qualname__}"
 
     def __call__(self, *args, **kwargs):
-        return self._wrapped(*args, **kwargs)
+        function = self._wrapped(*args, **kwargs)
+        profiler = profiling.current()
+        if profiler is not None:
+            function = profiler.instrument(self.name, function)
+        return function
+
+    def register_async(self, f):
+        """
+        Decorator that registers the decorated function as the asynchronous
+        variant of this function.
+        """
+        self.asynchronous = f
+        return f
 
 
 def function(f):
@@ -35,14 +71,32 @@ def function(f):
     return MinionFunction(f)
 
 
+@functools.lru_cache(maxsize = None)
 def import_path(path):
     """
     Imports the given dotted path.
+
+    The result is cached, so each path is only imported once per process.
     """
     module, name = path.rsplit(".", 1)
     return getattr(importlib.import_module(module), name)
 
 
+_watermark = contextvars.ContextVar('watermark', default = None)
+
+
+def watermark():
+    """
+    Returns the watermark for the job that is currently running, i.e. the
+    time at which the last successful run of the job started, or ``None`` if
+    there is no watermark.
+
+    Sources can use this to fetch only the items that have changed since the
+    last successful run.
+    """
+    return _watermark.get()
+
+
 def isiterable(obj):
     """
     Tests if an object is iterable but not a string or bytes.
@@ -124,7 +178,7 @@ class Template:
     Attributes:
         name: The name of the template.
         description: A brief description of the template.
-        parameters: A tuple of :class:`.Parameter`s for the template.
+        parameters: A frozenset of :class:`.Parameter`s for the template.
         spec: The dictionary specification of the template.
     """
     def __init__(self, name, description, parameters, spec):
@@ -132,7 +186,10 @@ class Template:
         self.description = description
         # Merge the set of given parameters with discovered ones, which will
         # have no description or example or default
-        self.parameters = set(parameters).union(self._find_parameters(spec))
+        # Templates may be shared between jobs, so the parameters are immutable
+        self.parameters = frozenset(parameters).union(
+            self._find_parameters(spec)
+        )
         self.spec = spec
 
     def _find_parameters(self, spec):
@@ -152,72 +209,157 @@ class Template:
             for v in spec:
                 yield from self._find_parameters(v)
 
-    def _resolve_refs(self, connectors, values, spec):
+    def _compile(self, values, spec):
         if isinstance(spec, collections.abc.Mapping):
-            if 'functionRef' in spec:
-                function_ref = self._resolve_refs(
-                    connectors,
-                    values,
-                    spec['functionRef']
+            if 'parameterRef' in spec:
+                parameter_name = self._compile(values, spec['parameterRef'])
+                # Get the parameter from the list of parameters and resolve it
+                # It should be impossible for this to raise StopIteration
+                parameter = next(
+                    p for p in self.parameters if p.name == parameter_name
                 )
+                # Parameter values are used as-is, so protect them from
+                # having any refs that they contain resolved
+                return { 'literalRef': parameter.resolve(values) }
+            else:
+                return { k: self._compile(values, v) for k, v in spec.items() }
+        elif isiterable(spec):
+            return [self._compile(values, v) for v in spec]
+        else:
+            return spec
+
+    def compile(self, values):
+        """
+        Compiles the template using the given parameter values.
+
+        Args:
+            values: The parameter values indexed by parameter name.
+
+        Returns:
+            The template spec with all the parameter refs substituted. Only
+            function and connector refs remain, so the result can be
+            serialised and resolved later using :meth:`Plan.resolve`.
+        """
+        return self._compile(values, self.spec)
+
+    def resolve_refs(self, connectors, values):
+        """
+        Resolves the references in the template using the given connectors and
+        parameter values and returns the resulting function.
+
+        Args:
+            connectors: The connectors to use, indexed by name.
+            values: The parameter values indexed by parameter name.
+
+        Returns:
+            The fully parameterised function.
+        """
+        return Plan(self.name, self.compile(values)).resolve(connectors)
+
+
+class Plan(collections.namedtuple('Plan', ['name', 'spec'])):
+    """
+    A Minion plan is a compiled job, i.e. a template spec in which all the
+    parameter refs have been substituted. Only function and connector refs
+    remain to be resolved at runtime.
+
+    Because a plan is made of plain data, it can be cached and re-used
+    without parsing or compiling the template again.
+
+    Attributes:
+        name: The name of the job that the plan was compiled from.
+        spec: The compiled spec.
+    """
+    def _resolve(self, connectors, spec):
+        if isinstance(spec, collections.abc.Mapping):
+            if 'literalRef' in spec:
+                return spec['literalRef']
+            elif 'functionRef' in spec:
+                function_ref = self._resolve(connectors, spec['functionRef'])
                 path = function_ref.pop('path')
                 function = import_path(path)
                 if not isinstance(function, MinionFunction):
                     raise TypeError(f"'{path}' is not a Minion function")
                 return function(**function_ref)
             elif 'connectorRef' in spec:
-                connector_name = self._resolve_refs(
-                    connectors,
-                    values,
-                    spec['connectorRef']
-                )
+                connector_name = self._resolve(connectors, spec['connectorRef'])
                 try:
                     return connectors[connector_name]
                 except KeyError:
                     raise LookupError(
                         f"Could not find connector '{connector_name}'"
                     )
-            elif 'parameterRef' in spec:
-                parameter_name = self._resolve_refs(
-                    connectors,
-                    values,
-                    spec['parameterRef']
-                )
-                # Get the parameter from the list of parameters and resolve it
-                # It should be impossible for this to raise StopIteration
-                parameter = next(
-                    p for p in self.parameters if p.name == parameter_name
-                )
-                return parameter.resolve(values)
             else:
-                return {
-                    k: self._resolve_refs(connectors, values, v)
-                    for k, v in spec.items()
-                }
+                return { k: self._resolve(connectors, v) for k, v in spec.items() }
         elif isiterable(spec):
-            return [self._resolve_refs(connectors, values, v) for v in spec]
+            return [self._resolve(connectors, v) for v in spec]
         else:
             return spec
 
-    def resolve_refs(self, connectors, values):
+    def resolve(self, connectors):
         """
-        Resolves the references in the template using the given connectors and
-        parameter values and returns the resulting function.
+        Resolves the function and connector refs in the plan using the given
+        connectors and returns the resulting function.
 
         Args:
             connectors: The connectors to use, indexed by name.
-            values: The parameter values indexed by parameter name.
 
         Returns:
             The fully parameterised function.
         """
-        return self._resolve_refs(connectors, values, self.spec)
+        return self._resolve(connectors, self.spec)
+
+    def run(
+        self,
+        connectors,
+        watermark = None,
+        engine = None,
+        profiler = None
+    ):
+        """
+        Runs the plan using the given connectors.
+
+        Args:
+            connectors: The connectors to use, indexed by name.
+            watermark: The watermark for the run (see :func:`watermark`).
+            engine: An alternative engine to run the plan with, e.g.
+                :class:`minion.aio.AsyncEngine`. It must have a ``run`` method
+                that takes the plan and connectors.
+            profiler: A :class:`minion.profiling.Profiler` to record the
+                statistics for each stage of the plan with.
+        """
+        token = _watermark.set(watermark)
+        try:
+            with profiling.activated(profiler):
+                self._run(connectors, engine)
+        except Job.Exit:
+            pass
+        finally:
+            _watermark.reset(token)
+
+    def _run(self, connectors, engine):
+        if engine is not None:
+            engine.run(self, connectors)
+        else:
+            result = self.resolve(connectors)()
+            # If the result is an iterable, ensure it has run to completion
+            if not isinstance(result, str) and \
+               isinstance(result, collections.abc.Iterable):
+                iterator = iter(result)
+                try:
+                    while True:
+                        next(iterator)
+                except StopIteration:
+                    pass
 
 
 class Job(collections.namedtuple('Job', ['name',
                                          'description',
                                          'template',
-                                         'values'])):
+                                         'values',
+                                         'schedule'],
+                                 # Jobs do not need a schedule
+                                 defaults = (None, ))):
     """
     A Minion job is a specific parameterisation of a template. It is not a
     complete function yet though, as the connectors are global and injected at
@@ -228,29 +370,34 @@ class Job(collections.namedtuple('Job', ['name',
         description: A brief description of the job.
         template: The :class:`Template` that the job uses.
         values: The parameter values to be used when resolving template refs.
+        schedule: An optional cron expression for when the job should run
+            when Minion is running as a daemon.
     """
     class Exit(Exception):
         """
         Exception that can be raised to bail on a pipeline.
         """
 
-    def run(self, connectors):
+    def compile(self):
+        """
+        Compiles the job into a :class:`Plan`.
+        """
+        return Plan(self.name, self.template.compile(self.values))
+
+    def run(
+        self,
+        connectors,
+        watermark = None,
+        engine = None,
+        profiler = None
+    ):
         """
         Runs the job using the given connectors.
 
         Args:
             connectors: The connectors to use, indexed by name.
+            watermark: The watermark for the run (see :func:`watermark`).
+            engine: An alternative engine to run the job with.
+            profiler: A profiler to record the statistics for the job with.
         """
-        try:
-            result = self.template.resolve_refs(connectors, self.values)()
-            # If the result is an iterable, ensure it has run to completion
-            if not isinstance(result, str) and \
-               isinstance(result, collections.Iterable):
-                iterator = iter(result)
-                try:
-                    while True:
-                        next(iterator)
-                except StopIteration:
-                    pass
-        except self.Exit:
-            pass
+        self.compile().run(connectors, watermark, engine, profiler)
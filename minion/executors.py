@@ -0,0 +1,324 @@
+"""
+Helpers for executing Minion work concurrently.
+"""
+
+import collections
+import concurrent.futures
+import contextvars
+import logging
+import queue
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+def submit(executor, function, *args, **kwargs):
+    """
+    Submits the given function to the executor, running it in a copy of the
+    current context so that context variables are propagated to the worker.
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, function, *args, **kwargs)
+
+
+def bounded_map(function, items, workers, window = None, ordered = True):
+    """
+    Lazily applies ``function`` to each item from ``items`` using a pool of
+    ``workers`` threads and returns an iterable of the results.
+
+    At most ``window`` items (defaulting to ``workers``) are in flight at
+    once, so the input is never consumed more than ``window`` items ahead of
+    the output. If ``ordered`` is true, results are returned in the same order
+    as the input, otherwise they are returned in the order they complete.
+
+    If ``function`` raises an exception, it is re-raised when the
+    corresponding result is reached and any outstanding work is cancelled.
+    """
+    window = max(window or workers, 1)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+    iterator = iter(items)
+    pending = collections.deque() if ordered else set()
+    add = pending.append if ordered else pending.add
+    try:
+        exhausted = False
+        while True:
+            # Top up the window
+            while not exhausted and len(pending) < window:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                else:
+                    add(submit(executor, function, item))
+            if not pending:
+                break
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, _ = concurrent.futures.wait(
+                    pending,
+                    return_when = concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    pending.discard(future)
+                    yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait = False)
+
+
+#: The default number of items that an iterator from :func:`tee` can get
+#: ahead of the others, and that a :class:`Prefetcher` fetches ahead
+DEFAULT_BUFFER = 1000
+
+
+class Tee:
+    """
+    Thread-safe equivalent of ``itertools.tee`` that splits one iterable into
+    ``n`` independent iterators, which can be consumed from different threads.
+    The iterators are created using :func:`tee`.
+
+    If ``buffer`` is not ``None``, no iterator can get more than ``buffer``
+    items ahead of the slowest one, and instead waits for it to catch up.
+    An iterator that is closed, e.g. because it is no longer used, stops
+    counting as the slowest one. To avoid waiting forever for an iterator
+    that is still open but will not be consumed until later, ``stalled`` can
+    be given as a function that takes the index of an iterator and returns
+    true if it is not being consumed, in which case the others are allowed
+    to get further ahead of it.
+
+    If ``cancel`` is given, it is a ``threading.Event`` that ends all the
+    iterators when set.
+    """
+    def __init__(
+        self,
+        iterable,
+        n,
+        buffer = DEFAULT_BUFFER,
+        cancel = None,
+        stalled = None
+    ):
+        self._source = iter(iterable)
+        self._buffers = [collections.deque() for _ in range(n)]
+        self._open = set(range(n))
+        self._buffer = buffer
+        self._cancel = cancel
+        self._stalled = stalled
+        self._warned = False
+        self._exhausted = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    def _cancelled(self):
+        return self._cancel is not None and self._cancel.is_set()
+
+    def _has_room(self, index):
+        if self._buffer is None:
+            return True
+        for other in self._open:
+            if other == index or len(self._buffers[other]) < self._buffer:
+                continue
+            if self._stalled is not None and self._stalled(other):
+                if not self._warned:
+                    logger.warning(
+                        f"Buffering more than {self._buffer} items as an "
+                        "iterator is not being consumed"
+                    )
+                    self._warned = True
+                continue
+            return False
+        return True
+
+    def iterator(self, index):
+        """
+        Returns the iterator with the given index. It must only be called once
+        for each index.
+        """
+        buffer = self._buffers[index]
+        try:
+            while True:
+                with self._cond:
+                    while not buffer and \
+                          not self._exhausted and \
+                          not self._cancelled() and \
+                          not self._has_room(index):
+                        # Time out to check for cancellation and stalls
+                        self._cond.wait(0.1)
+                    if buffer:
+                        item = buffer.popleft()
+                    elif self._error is not None:
+                        raise self._error
+                    elif self._exhausted or self._cancelled():
+                        return
+                    else:
+                        # Fetch the next item on behalf of all the iterators
+                        try:
+                            item = next(self._source)
+                        except StopIteration:
+                            self._exhausted = True
+                            return
+                        except Exception as exc:
+                            self._exhausted = True
+                            self._error = exc
+                            raise
+                        finally:
+                            self._cond.notify_all()
+                        for other in self._open:
+                            if other != index:
+                                self._buffers[other].append(item)
+                    self._cond.notify_all()
+                yield item
+        finally:
+            with self._cond:
+                self._open.discard(index)
+                buffer.clear()
+                # If none of the iterators are used any more, stop the source
+                if not self._open and not self._exhausted:
+                    self._exhausted = True
+                    close = getattr(self._source, 'close', None)
+                    if close is not None:
+                        close()
+                self._cond.notify_all()
+
+
+def tee(iterable, n, buffer = DEFAULT_BUFFER, cancel = None, stalled = None):
+    """
+    Returns a list of ``n`` independent iterators over the given iterable,
+    which can be consumed from different threads (see :class:`Tee`).
+    """
+    # The Tee is not kept, so that each iterator is closed as soon as it is
+    # no longer used
+    t = Tee(iterable, n, buffer, cancel, stalled)
+    return [t.iterator(index) for index in range(n)]
+
+
+# Marks the end of the items from a Prefetcher
+_DONE = object()
+
+
+class _Feed:
+    # State shared between a Prefetcher and its background thread. It does
+    # not reference the Prefetcher, so that the Prefetcher can be closed as
+    # soon as it is no longer used.
+    def __init__(self, size, cancel):
+        self.queue = queue.Queue(maxsize = size or 0)
+        self.closed = threading.Event()
+        self.cancel = cancel
+        self.stalled = False
+
+    def stopped(self):
+        return self.closed.is_set() or (
+            self.cancel is not None and self.cancel.is_set()
+        )
+
+    def put(self, value):
+        # Put the value in the queue, giving up if the consumer goes away
+        while not self.stopped():
+            try:
+                self.queue.put(value, timeout = 0.1)
+            except queue.Full:
+                self.stalled = True
+            else:
+                self.stalled = False
+                return True
+        return False
+
+    def run(self, iterator):
+        try:
+            for item in iterator:
+                if not self.put((item, None)):
+                    return
+        except BaseException as exc:
+            self.put((_DONE, exc))
+        else:
+            self.put((_DONE, None))
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+
+class Prefetcher:
+    """
+    Iterator that consumes the given iterable in a background thread, so that
+    items are fetched ahead of the consumer.
+
+    At most ``size`` items are fetched ahead, or any number if ``size`` is
+    ``None``. Exceptions raised by the iterable are re-raised by the consumer
+    when it reaches them.
+
+    Fetching stops and the iterable is closed when the prefetcher is closed
+    or is no longer used. If ``cancel`` is given, it is a
+    ``threading.Event`` that has the same effect when set, so that it can be
+    shared by several prefetchers. Once stopped, the consumer sees the end of
+    the items.
+    """
+    def __init__(self, iterable, size = DEFAULT_BUFFER, cancel = None):
+        self._feed = _Feed(size, cancel)
+        self._finished = False
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(
+            target = context.run,
+            args = (self._feed.run, iter(iterable)),
+            daemon = True
+        )
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def _stopped(self):
+        # Called when the consumer finds that fetching has stopped
+        self._finished = True
+        raise StopIteration
+
+    def __next__(self):
+        while True:
+            if self._finished:
+                raise StopIteration
+            if self._feed.stopped():
+                self._stopped()
+            try:
+                item, error = self._feed.queue.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+            break
+        if item is _DONE:
+            self._finished = True
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    @property
+    def stalled(self):
+        """
+        Indicates if fetching is waiting for the consumer, because the
+        maximum number of items have been fetched ahead.
+        """
+        return self._feed.stalled
+
+    def qsize(self):
+        """
+        Returns the number of items that have been fetched but not consumed.
+        """
+        return self._feed.queue.qsize()
+
+    def maxsize(self):
+        """
+        Returns the maximum number of items that are fetched ahead, or zero if
+        there is no maximum.
+        """
+        return self._feed.queue.maxsize
+
+    def close(self):
+        """
+        Stops fetching items.
+        """
+        self._feed.closed.set()
+        self._finished = True
+
+    def __del__(self):
+        self._feed.closed.set()
@@ -3,13 +3,20 @@
 """
 
 import functools
+import itertools
 import pprint
+import re
+import threading
+import weakref
 import collections
+import collections.abc
+from concurrent.futures import ThreadPoolExecutor
 
 import jinja2
-import yaml
 
 from .core import function as minion_function, Job
+from . import records, templating, yamlio
+from .executors import bounded_map, submit, tee, DEFAULT_BUFFER, Prefetcher
 
 
 @minion_function
@@ -23,23 +30,77 @@ def compose(functions):
     return lambda *args: functools.reduce(lambda i, f: f(i), functions, next(iter(args), None))
 
 
+def _batches(items, batch_size):
+    # Splits the items into lists of at most batch_size items
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
 @minion_function
-def map(function):
+def map(function, batch_size = None):
     """
     Returns a function that accepts an iterable as the incoming item and returns
     a new iterable that is the result of applying the given function to each
     item.
+
+    If ``batch_size`` is given and the function supports batches, i.e. it has
+    a ``batch`` attribute that takes a list of items and returns a list of
+    results (e.g. :func:`expression`), the items are passed to it in lists of
+    up to ``batch_size`` items. This means that up to ``batch_size`` items are
+    read ahead of the results.
     """
+    batch = getattr(function, 'batch', None)
+    if batch_size and batch is not None:
+        return lambda items: (
+            result
+            for items_batch in _batches(items, batch_size)
+            for result in batch(items_batch)
+        )
     return lambda items: (function(item) for item in items)
 
 
 @minion_function
-def filter(predicate):
+def parallel_map(function, workers = 4, ordered = True, window = None):
+    """
+    Returns a function that accepts an iterable as the incoming item and returns
+    a new iterable that is the result of applying the given function to each
+    item using a pool of ``workers`` threads.
+
+    This is useful when the function does I/O, e.g. calls a connector. If
+    ``ordered`` is false, results are returned as soon as they are available
+    rather than in the same order as the incoming items. At most ``window``
+    items (defaulting to ``workers``) are read ahead of the results.
+
+    If the function raises an exception for any item, including
+    :class:`~minion.core.Job.Exit`, it is re-raised when that item's result is
+    reached and the outstanding items are abandoned.
+    """
+    return lambda items: bounded_map(function, items, workers, window, ordered)
+
+
+@minion_function
+def filter(predicate, batch_size = None):
     """
     Returns a function that accepts an iterable as the incoming item and returns
     a new iterable containing only the items for which the given predicate
     returns true.
+
+    If ``batch_size`` is given and the predicate supports batches, the items
+    are passed to it in lists of up to ``batch_size`` items, as for
+    :func:`map`.
     """
+    batch = getattr(predicate, 'batch', None)
+    if batch_size and batch is not None:
+        return lambda items: (
+            item
+            for items_batch in _batches(items, batch_size)
+            for item, keep in zip(items_batch, batch(items_batch))
+            if keep
+        )
     return lambda items: (item for item in items if predicate(item))
 
 
@@ -49,11 +110,16 @@ def zip_matching(matcher):
     Returns a function that accepts a tuple containing two iterables as the
     incoming item and returns an iterable of tuples of matching items as per
     the given matcher.
+
+    The second iterable is iterated once for each item from the first, so it
+    is copied into a tuple unless it is already a sequence, e.g. a list or a
+    :class:`~minion.records.RecordTable`.
     """
     def func(item):
         first, second = item
-        # second will be iterated multiple times, so force it to be a tuple
-        second = tuple(second)
+        # second will be iterated multiple times, so make sure that is possible
+        if not isinstance(second, collections.abc.Sequence):
+            second = tuple(second)
         for item1 in first:
             for item2 in second:
                 if matcher((item1, item2)):
@@ -64,6 +130,51 @@ def zip_matching(matcher):
     return func
 
 
+@minion_function
+def zip_keyed(first_key, second_key, all_matches = False, unmatched = False):
+    """
+    Returns a function that accepts a tuple containing two iterables as the
+    incoming item and returns an iterable of tuples of matching items, where
+    two items match if ``first_key`` and ``second_key`` return the same value
+    for them. The keys must be hashable.
+
+    This produces the same output as :func:`zip_matching` with an equality
+    matcher, but the second iterable is indexed by key once so that each item
+    from the first iterable is matched with a single lookup.
+
+    If ``all_matches`` is true, a tuple is returned for every item from the
+    second iterable that matches, rather than just the first. If ``unmatched``
+    is true, items from the second iterable that did not match any item from
+    the first iterable are returned at the end as ``(None, item2)``.
+    """
+    def func(item):
+        first, second = item
+        # Index the second iterable by key, preserving the original order of
+        # items with the same key
+        index = collections.OrderedDict()
+        for item2 in second:
+            index.setdefault(second_key(item2), []).append(item2)
+        matched = set()
+        for item1 in first:
+            key = first_key(item1)
+            matches = index.get(key)
+            if matches:
+                matched.add(key)
+                if all_matches:
+                    for item2 in matches:
+                        yield (item1, item2)
+                else:
+                    yield (item1, matches[0])
+            else:
+                yield (item1, None)
+        if unmatched:
+            for key, matches in index.items():
+                if key not in matched:
+                    for item2 in matches:
+                        yield (None, item2)
+    return func
+
+
 @minion_function
 def take(number):
     """
@@ -78,6 +189,16 @@ def take(number):
     return func
 
 
+@minion_function
+def to_table(fields):
+    """
+    Returns a function that takes an iterable as the incoming item and returns
+    a :class:`~minion.records.RecordTable` containing the given fields of each
+    item, which uses much less memory than a list of the items.
+    """
+    return lambda items: records.RecordTable(fields, items)
+
+
 @minion_function
 def identity():
     """
@@ -88,12 +209,68 @@ def identity():
 
 
 @minion_function
-def fork(functions):
+def fork(functions, concurrent = False, buffer = DEFAULT_BUFFER):
     """
     Returns a function that executes each of the given functions for the
     incoming item and returns a tuple of the results in the same order.
+
+    If the incoming item is an iterator, each function receives its own
+    independent iterator over the items.
+
+    If ``concurrent`` is true, the functions are executed in separate threads.
+    Any results that are iterators are then consumed in the background, so
+    that e.g. listings from two different connectors are fetched at the same
+    time. In this case, up to ``buffer`` items of each result are fetched
+    ahead, and no function can read more than ``buffer`` items of an
+    incoming iterator ahead of the others. If ``buffer`` is ``None``, there
+    is no limit.
+
+    The limits never cause the results to wait for each other forever. If a
+    result is not being consumed, e.g. because the results are consumed one
+    after the other, the other functions can read further ahead of it, at the
+    cost of buffering the extra items. When a result is no longer used, e.g.
+    because its consumer stopped early, it stops being fetched.
     """
-    return lambda item: tuple(f(item) for f in functions)
+    def func(item):
+        if not concurrent:
+            if isinstance(item, collections.abc.Iterator):
+                items = itertools.tee(item, len(functions))
+            else:
+                items = [item] * len(functions)
+            return tuple(f(i) for f, i in zip(functions, items))
+        # Stops all the background work if any function fails
+        cancel = threading.Event()
+        # The prefetchers are referenced weakly, so that each one is closed as
+        # soon as its consumer stops using it
+        prefetchers = [None] * len(functions)
+        def stalled(index):
+            prefetcher = prefetchers[index] and prefetchers[index]()
+            return prefetcher is not None and prefetcher.stalled
+        if isinstance(item, collections.abc.Iterator):
+            items = tee(item, len(functions), buffer, cancel, stalled)
+        else:
+            items = [item] * len(functions)
+        def run(index, function, item):
+            result = function(item)
+            if isinstance(result, collections.abc.Iterator):
+                result = Prefetcher(result, buffer, cancel)
+                prefetchers[index] = weakref.ref(result)
+            return result
+        executor = ThreadPoolExecutor(max_workers = len(functions))
+        succeeded = False
+        try:
+            futures = [
+                submit(executor, run, index, f, i)
+                for index, (f, i) in enumerate(zip(functions, items))
+            ]
+            results = tuple(future.result() for future in futures)
+            succeeded = True
+            return results
+        finally:
+            if not succeeded:
+                cancel.set()
+            executor.shutdown(wait = False)
+    return func
 
 
 @minion_function
@@ -126,19 +303,134 @@ def when(condition, then, default = lambda item: item):
     return lambda item: then(item) if condition(item) else default(item)
 
 
-jinja2_environment = jinja2.Environment(extensions=['jinja2.ext.loopcontrols'])
+# Kept for backwards compatibility - use minion.templating instead
+jinja2_environment = templating.environment
+
+
+# Matches a string consisting of a single Jinja2 expression
+_EXPRESSION_REGEX = re.compile(
+    r'^\s*\{\{(?P<expression>.*)\}\}\s*$',
+    re.DOTALL
+)
+
+
+def _as_yaml(value, quoted = False):
+    # Returns the value that rendering the value into a YAML template and
+    # parsing the result would give. Strings in lists and dicts are rendered
+    # quoted, so they remain strings.
+    if isinstance(value, (bool, int)):
+        return value
+    elif isinstance(value, str):
+        return value if quoted else yamlio.scalar(value)
+    elif value is None or isinstance(value, float):
+        return yamlio.scalar(str(value))
+    elif isinstance(value, list):
+        return [_as_yaml(v, True) for v in value]
+    elif isinstance(value, dict):
+        return { _as_yaml(k, True): _as_yaml(v, True) for k, v in value.items() }
+    return value
+
+
+def _collect(values, index, value):
+    # Used by structured templates to collect the value of each expression,
+    # typed as if it had been rendered, in which case undefined is empty
+    if isinstance(value, jinja2.Undefined):
+        values[index] = None
+    else:
+        values[index] = _as_yaml(value)
+    return ''
+
+
+class _StructuredTemplate:
+    """
+    Callable that builds a structure of dicts and lists from a dictionary of
+    template variables, as described in :func:`template`.
+
+    All the expressions in the structure are evaluated by rendering a single
+    Jinja2 template, which avoids the overhead of rendering a template for
+    each one. The results are typed as YAML scalars, so that they are the
+    same as if the structure was written as a YAML template.
+    """
+    def __init__(self, spec):
+        self._expressions = []
+        self._build = self._compile(spec)
+        self._template = templating.get_template(''.join(
+            f"{{{{ __collect(__values, {i}, ({expression})) }}}}"
+            for i, expression in enumerate(self._expressions)
+        ))
+
+    def _compile(self, spec):
+        # Returns a function that builds the result for the spec from the
+        # values of the expressions and the template variables
+        if isinstance(spec, collections.abc.Mapping):
+            items = [
+                (self._compile(k), self._compile(v))
+                for k, v in spec.items()
+            ]
+            return lambda values, variables: {
+                k(values, variables): v(values, variables) for k, v in items
+            }
+        elif isinstance(spec, (list, tuple)):
+            items = [self._compile(v) for v in spec]
+            return lambda values, variables: [
+                v(values, variables) for v in items
+            ]
+        elif isinstance(spec, str):
+            match = _EXPRESSION_REGEX.match(spec)
+            expression = match.group('expression') if match else None
+            if expression and '{{' not in expression and '}}' not in expression:
+                # Strings that are a single expression produce the value of
+                # the expression, without converting it to a string
+                index = len(self._expressions)
+                self._expressions.append(expression)
+                return lambda values, variables: values[index]
+            elif '{{' in spec or '{%' in spec or '{#' in spec:
+                template = templating.get_template(spec)
+                return lambda values, variables: yamlio.scalar(
+                    template.render(**variables)
+                )
+        return lambda values, variables: spec
+
+    def __call__(self, variables):
+        values = [None] * len(self._expressions)
+        if values:
+            self._template.render(
+                __collect = _collect,
+                __values = values,
+                **variables
+            )
+        return self._build(values, variables)
 
 
 @minion_function
-def template(template, globals = None):
+def template(template, globals = None, parser = 'yaml'):
     """
     Returns a function that evaluates the given Jinja2 template with the
     incoming item as ``input`` and the optional dictionary of globals. The
     result is parsed as YAML and returned.
+
+    ``parser`` selects the backend used to parse the result (see
+    :func:`minion.yamlio.parser`). Templates that render JSON can use
+    ``json``, which is much faster.
+
+    Alternatively, the template can be a structure of dicts and lists, in
+    which case the result is built directly without rendering or parsing any
+    YAML. Each string in the structure that consists of a single expression,
+    e.g. ``"{{ input.title }}"``, is replaced with the value of the expression.
+    Any other string containing Jinja2 syntax is rendered, and everything else
+    is returned unchanged. The results are typed in the same way as when the
+    rendered YAML is parsed, e.g. a title of ``"123"`` becomes an integer and
+    ``None`` becomes ``"None"``, including the values in lists and dicts.
+    Other objects are returned as they are, rather than as their rendered
+    representation.
     """
     globals = globals if globals is not None else {}
-    template = jinja2_environment.from_string(template)
-    return lambda item: yaml.safe_load(template.render(input = item, **globals))
+    if not isinstance(template, str):
+        build = _StructuredTemplate(template)
+        return lambda item: build(dict(globals, input = item))
+    template = templating.get_template(template)
+    parse = yamlio.parser(parser)
+    return lambda item: parse(template.render(input = item, **globals))
 
 
 @minion_function
@@ -147,10 +439,22 @@ def expression(expression, globals = None):
     Returns a function that evaluates the given Jinja2 expression with the
     incoming item as ``input`` and optional dictionary of globals and returns
     the result.
+
+    The function supports batches (see :func:`map`), which are evaluated
+    together. Simple expressions, e.g. comparisons of fields combined with
+    ``and`` and ``or``, are compiled to Python rather than evaluated by
+    Jinja2, whether or not they are batched.
     """
     globals = globals if globals is not None else {}
-    expression = jinja2_environment.compile_expression(expression)
-    return lambda item: expression(input = item, **globals)
+    source = expression
+    expression = templating.compile_expression(source)
+    func = lambda item: expression(input = item, **globals)
+    # The batch version is only compiled if it is used, and then only once
+    @functools.lru_cache(maxsize = None)
+    def batch_expression():
+        return templating.compile_batch_expression(source, 'input')
+    func.batch = lambda items: batch_expression()(items, **globals)
+    return func
 
 
 @minion_function
@@ -160,11 +464,20 @@ def pretty_print():
     ``pprint.pprint`` before returning it.
     """
     def func(item):
-        # Convert anything iterable to a list first
-        if isinstance(item, collections.Iterable) and not isinstance(item, str):
-            to_print = list(item)
-        else:
+        if isinstance(item, records.RecordTable):
+            # Print the rows in the same way as a list of dicts
+            pprint.pprint([row._asdict() for row in item])
+            return item
+        # Convert anything iterable to a list first, unless it is already a
+        # sequence that can be printed without copying it
+        if isinstance(item, collections.abc.Sequence) or \
+           not isinstance(item, collections.abc.Iterable):
             to_print = item
+        elif isinstance(item, collections.abc.Iterator):
+            # The items have been consumed, so return the printed copy
+            item = to_print = list(item)
+        else:
+            to_print = list(item)
         pprint.pprint(to_print)
         return item
     return func
@@ -0,0 +1,281 @@
+"""
+Pipeline engine for running Minion plans with bounded queues between stages.
+
+When a plan whose top-level function is a ``compose`` is run using
+:class:`PipelineEngine`, each of the composed functions is run as a separate
+stage. Every stage that produces an iterator is consumed by a background
+thread that feeds a queue holding at most ``buffer`` items, from which the
+next stage reads. This means that a fast stage, e.g. a source that fetches
+pages of issues, can run ahead of a slow one, e.g. a sink that writes issues,
+until the queue between them is full, at which point it waits.
+
+Stages that do not return iterators, e.g. functions that collect all their
+items into a list, are passed on as-is, exactly as for ``compose``.
+
+When any stage raises :class:`~minion.core.Job.Exit`, the pipeline is
+cancelled cooperatively: the background threads stop fetching items, the
+iterators of all the stages are closed and every stage that reads from a
+queue gets :class:`~minion.core.Job.Exit` rather than the end of its input,
+so that no stage treats partial input as complete.
+"""
+
+import collections
+import collections.abc
+import logging
+import threading
+import time
+
+from .core import import_path, isiterable, Job
+from .executors import Prefetcher
+from . import functions
+
+
+logger = logging.getLogger(__name__)
+
+
+#: The default number of items that can be queued between two stages
+DEFAULT_BUFFER = 100
+
+
+#: Statistics for a single stage, with the throughput in items per second
+StageStats = collections.namedtuple(
+    'StageStats',
+    ['name', 'items', 'depth', 'max_depth', 'throughput']
+)
+
+
+class _Queue(Prefetcher):
+    # Bounded queue that is fed with the items from a stage by a background
+    # thread, counting the items and treating Job.Exit as a cancellation
+    def __init__(self, iterable, size, stop, cancel, cancelled):
+        self.items = 0
+        self.max_depth = 0
+        self._cancel = cancel
+        self._cancelled = cancelled
+        super().__init__(self._count(iterable), size, stop)
+
+    def _stopped(self):
+        # The consumer must not see the end of the items if the pipeline was
+        # cancelled, as they are incomplete
+        if self._cancelled.is_set():
+            self._finished = True
+            raise Job.Exit()
+        super()._stopped()
+
+    def _count(self, iterable):
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                self.items += 1
+                # Including the item that is about to be queued, which may
+                # have to wait for room
+                self.max_depth = max(
+                    self.max_depth,
+                    min(self.qsize() + 1, self.maxsize())
+                )
+                yield item
+        except Job.Exit:
+            self._cancel()
+            raise
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+
+class _Stage:
+    # A single stage of the pipeline and the queue that holds its output
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+        self.queue = None
+        # Only used for the output of the last stage, which is not queued
+        self.items = 0
+
+    def stats(self, elapsed):
+        if self.queue is not None:
+            items = self.queue.items
+            depth = self.queue.qsize()
+            max_depth = self.queue.max_depth
+        else:
+            items, depth, max_depth = self.items, 0, 0
+        return StageStats(
+            self.name,
+            items,
+            depth,
+            max_depth,
+            items / elapsed if elapsed > 0 else 0.0
+        )
+
+
+class Pipeline:
+    """
+    Runs a sequence of functions as the stages of a pipeline, with at most
+    ``buffer`` items queued between each pair of stages.
+
+    ``stages`` is a list of ``(name, function)`` pairs. As for ``compose``,
+    the first function is called with ``None`` and each subsequent function
+    is called with the result of the previous one.
+
+    The statistics for the stages can be fetched at any time, including while
+    the pipeline is running, using :meth:`stats`.
+    """
+    def __init__(self, stages, buffer = DEFAULT_BUFFER):
+        self.buffer = max(buffer, 1)
+        self._stages = [_Stage(name, function) for name, function in stages]
+        # Set when the pipeline is cancelled
+        self._cancel = threading.Event()
+        # Set to stop the background threads, shared by all the queues
+        self._stop = threading.Event()
+        self._started = None
+        self._finished = None
+
+    @property
+    def cancelled(self):
+        """
+        Indicates if the pipeline was cancelled.
+        """
+        return self._cancel.is_set()
+
+    def cancel(self):
+        """
+        Cancels the pipeline. Stages that are running are not interrupted,
+        but no more items are passed between them and any stage that reads
+        from a queue gets :class:`~minion.core.Job.Exit`.
+        """
+        self._cancel.set()
+        self._stop.set()
+
+    def _drain(self, stage, result):
+        # Run the last stage to completion, or until the pipeline is cancelled
+        # and the stage gets Job.Exit
+        if not isinstance(result, collections.abc.Iterable) or \
+           isinstance(result, str):
+            return
+        iterator = iter(result)
+        try:
+            for _ in iterator:
+                stage.items += 1
+                if self._cancel.is_set():
+                    raise Job.Exit()
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def run(self):
+        """
+        Runs the pipeline until the last stage is exhausted or the pipeline
+        is cancelled.
+        """
+        self._started = time.perf_counter()
+        try:
+            result = None
+            for index, stage in enumerate(self._stages):
+                if self._cancel.is_set():
+                    return
+                result = stage.function(result)
+                is_last = index == len(self._stages) - 1
+                if not is_last and \
+                   isinstance(result, collections.abc.Iterator):
+                    stage.queue = _Queue(
+                        result,
+                        self.buffer,
+                        self._stop,
+                        self.cancel,
+                        self._cancel
+                    )
+                    result = stage.queue
+            self._drain(self._stages[-1], result)
+        except Job.Exit:
+            self.cancel()
+        finally:
+            # Stop any stages that are still running in the background, e.g.
+            # if a stage failed
+            self._stop.set()
+            self._finished = time.perf_counter()
+            if self._cancel.is_set():
+                logger.info("Pipeline cancelled")
+
+    def stats(self):
+        """
+        Returns a list of :class:`StageStats`, one for each stage.
+        """
+        if self._started is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._finished or time.perf_counter()) - self._started
+        return [stage.stats(elapsed) for stage in self._stages]
+
+    def table(self):
+        """
+        Returns the statistics formatted as a table.
+        """
+        from tabulate import tabulate
+        return tabulate(
+            [
+                (s.name, s.items, s.depth, s.max_depth, s.throughput)
+                for s in self.stats()
+            ],
+            headers = (
+                'Stage',
+                'Items',
+                'Queued',
+                'Max queued',
+                'Items/s'
+            ),
+            tablefmt = 'psql',
+            floatfmt = '.1f'
+        )
+
+
+def _stage_name(spec, index):
+    # Names the stage after the path of its function, if it has one
+    path = None
+    if isinstance(spec, collections.abc.Mapping) and 'functionRef' in spec:
+        path = spec['functionRef'].get('path')
+    return f"{path if isinstance(path, str) else 'stage'} [{index}]"
+
+
+def stages(plan, connectors):
+    """
+    Resolves the given plan into a list of ``(name, function)`` pairs, one
+    for each function in a top-level ``compose``, or a single pair if the
+    plan is not a ``compose``.
+    """
+    spec = plan.spec
+    if isinstance(spec, collections.abc.Mapping) and 'functionRef' in spec:
+        path = plan._resolve(connectors, spec['functionRef'].get('path'))
+        specs = spec['functionRef'].get('functions')
+        if isinstance(path, str) and \
+           import_path(path) is functions.compose and \
+           isiterable(specs):
+            return [
+                (_stage_name(s, i), plan._resolve(connectors, s))
+                for i, s in enumerate(specs, start = 1)
+            ]
+    return [(_stage_name(spec, 1), plan.resolve(connectors))]
+
+
+class PipelineEngine:
+    """
+    Engine that runs plans as a :class:`Pipeline`, with at most ``buffer``
+    items queued between each pair of stages.
+
+    If ``report`` is given, it is called with the name of the plan and the
+    pipeline after each run, including runs that fail.
+    """
+    def __init__(self, buffer = DEFAULT_BUFFER, report = None):
+        self.buffer = buffer
+        self.report = report
+
+    def run(self, plan, connectors):
+        """
+        Runs the given plan using the given connectors.
+        """
+        pipeline = Pipeline(stages(plan, connectors), self.buffer)
+        try:
+            pipeline.run()
+        finally:
+            if self.report is not None:
+                self.report(plan.name, pipeline)
@@ -0,0 +1,331 @@
+"""
+Profiler for the stages of a Minion pipeline.
+
+While a :class:`Profiler` is active (see :func:`activated`), each function
+returned by a :class:`~minion.core.MinionFunction` is instrumented as a
+stage. For each stage, the profiler records the number of calls, the number
+of items produced by any iterator that it returns, the cumulative and self
+wall time and the time spent blocked on I/O.
+
+Time spent in a stage includes the time spent advancing the iterators that it
+returns, since that is where lazy stages do their work. Self time excludes
+the time spent in other stages called from it, e.g. pulling items from an
+upstream stage. Stages are tracked per thread, so work done in other threads
+is attributed to the stage that runs in that thread.
+
+The asynchronous variants of functions used by :mod:`minion.aio` are
+instrumented using :meth:`Profiler.instrument_async`. As several of them run
+at once on the event loop, they are tracked per task rather than per thread,
+and the self time of a stage that awaits several stages at once is the time
+that is not spent waiting for any of them.
+
+When no profiler is active, functions are not instrumented, so the only cost
+is a check when each function is created and each HTTP request is made.
+"""
+
+import collections
+import collections.abc
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+
+
+#: The default maximum number of events to record for a Chrome trace
+DEFAULT_MAX_EVENTS = 100000
+
+
+# The profiler for the current context, if any
+_current = contextvars.ContextVar('profiler', default = None)
+
+
+def current():
+    """
+    Returns the active profiler, or ``None`` if there is no active profiler.
+    """
+    return _current.get()
+
+
+@contextlib.contextmanager
+def activated(profiler):
+    """
+    Context manager that makes the given profiler active. If ``profiler`` is
+    ``None``, profiling is disabled.
+    """
+    token = _current.set(profiler)
+    try:
+        yield profiler
+    finally:
+        _current.reset(token)
+
+
+#: Statistics for a single stage, with times in seconds
+StageStats = collections.namedtuple(
+    'StageStats',
+    ['name', 'calls', 'items', 'total', 'self', 'io']
+)
+
+
+class _Stage:
+    # Mutable counters for a stage
+    __slots__ = ('name', 'calls', 'items', 'total', 'children', 'io')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.items = 0
+        self.total = 0.0
+        self.children = 0.0
+        self.io = 0.0
+
+
+# Sentinel for the end of an iterator
+_END = object()
+
+
+# The asynchronous stage that is running in the current task, if any
+_async_stage = contextvars.ContextVar('async_stage', default = None)
+
+
+class Profiler:
+    """
+    Collects statistics for the stages of a pipeline.
+
+    If ``trace`` is true, up to ``max_events`` timed events are also recorded
+    so that a Chrome trace can be produced using :meth:`chrome_trace`.
+    """
+    def __init__(self, trace = False, max_events = DEFAULT_MAX_EVENTS):
+        self.trace = trace
+        self.max_events = max_events
+        self._stages = []
+        self._events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _event(self, name, category, start, duration):
+        if self.trace and len(self._events) < self.max_events:
+            self._events.append(dict(
+                name = name,
+                cat = category,
+                ph = 'X',
+                ts = (start - self._origin) * 1e6,
+                dur = duration * 1e6,
+                pid = os.getpid(),
+                tid = threading.get_ident()
+            ))
+
+    def _enter(self, stage):
+        self._stack().append(stage)
+        return time.perf_counter()
+
+    def _exit(self, stage, start, category):
+        elapsed = time.perf_counter() - start
+        stack = self._stack()
+        stack.pop()
+        with self._lock:
+            stage.total += elapsed
+            if stack:
+                stack[-1].children += elapsed
+            self._event(stage.name, category, start, elapsed)
+
+    def _add_stage(self, name):
+        with self._lock:
+            stage = _Stage(f"{name} [{len(self._stages) + 1}]")
+            self._stages.append(stage)
+        return stage
+
+    async def _await(self, stage, awaitable, category):
+        # Times awaiting the awaitable as part of the stage
+        parent = _async_stage.get()
+        token = _async_stage.set(stage)
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            elapsed = time.perf_counter() - start
+            _async_stage.reset(token)
+            with self._lock:
+                stage.total += elapsed
+                if parent is not None:
+                    parent.children += elapsed
+                self._event(stage.name, category, start, elapsed)
+
+    async def _aiterate(self, stage, iterator):
+        # Times each item fetched from an asynchronous iterator returned by
+        # the stage
+        try:
+            while True:
+                try:
+                    item = await self._await(
+                        stage,
+                        iterator.__anext__(),
+                        'next'
+                    )
+                except StopAsyncIteration:
+                    return
+                with self._lock:
+                    stage.items += 1
+                yield item
+        finally:
+            aclose = getattr(iterator, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+
+    def _iterate(self, stage, iterator):
+        # Times each item fetched from an iterator returned by the stage
+        try:
+            while True:
+                start = self._enter(stage)
+                try:
+                    item = next(iterator, _END)
+                finally:
+                    self._exit(stage, start, 'next')
+                if item is _END:
+                    return
+                with self._lock:
+                    stage.items += 1
+                yield item
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def instrument(self, name, function):
+        """
+        Returns a function that calls the given function and records its
+        statistics as a new stage with the given name.
+        """
+        stage = self._add_stage(name)
+        def instrumented(function):
+            def func(*args, **kwargs):
+                start = self._enter(stage)
+                try:
+                    result = function(*args, **kwargs)
+                finally:
+                    self._exit(stage, start, 'call')
+                with self._lock:
+                    stage.calls += 1
+                if isinstance(result, collections.abc.Iterator):
+                    return self._iterate(stage, result)
+                return result
+            return func
+        func = instrumented(function)
+        # Preserve support for batches (see minion.functions.map)
+        batch = getattr(function, 'batch', None)
+        if batch is not None:
+            func.batch = instrumented(batch)
+        return func
+
+    def instrument_async(self, name, function):
+        """
+        Returns a coroutine function that awaits the given coroutine function
+        and records its statistics as a new stage with the given name, in the
+        same way as :meth:`instrument`.
+        """
+        stage = self._add_stage(name)
+        def instrumented(function):
+            async def func(*args, **kwargs):
+                result = await self._await(
+                    stage,
+                    function(*args, **kwargs),
+                    'call'
+                )
+                with self._lock:
+                    stage.calls += 1
+                if hasattr(result, '__aiter__'):
+                    return self._aiterate(stage, result.__aiter__())
+                elif isinstance(result, collections.abc.Iterator):
+                    return self._iterate(stage, result)
+                return result
+            return func
+        func = instrumented(function)
+        batch = getattr(function, 'batch', None)
+        if batch is not None:
+            func.batch = instrumented(batch)
+        return func
+
+    def record_io(self, description, start):
+        """
+        Records that the current thread was blocked on I/O, described by
+        ``description``, from ``start`` (from ``time.perf_counter``) until
+        now. The time is attributed to the innermost active stage.
+        """
+        elapsed = time.perf_counter() - start
+        stack = self._stack()
+        with self._lock:
+            if stack:
+                stack[-1].io += elapsed
+            self._event(description, 'io', start, elapsed)
+
+    def stats(self):
+        """
+        Returns a list of :class:`StageStats`, one for each stage in the order
+        they were created.
+        """
+        with self._lock:
+            return [
+                StageStats(
+                    stage.name,
+                    stage.calls,
+                    stage.items,
+                    stage.total,
+                    # Concurrent asynchronous stages can overlap
+                    max(stage.total - stage.children, 0.0),
+                    stage.io
+                )
+                for stage in self._stages
+            ]
+
+    def table(self):
+        """
+        Returns the statistics formatted as a table, with the stages that took
+        the most self time first.
+        """
+        from tabulate import tabulate
+        return tabulate(
+            [
+                (
+                    s.name,
+                    s.calls,
+                    s.items,
+                    f"{s.total:.3f}",
+                    f"{s.self:.3f}",
+                    f"{s.io:.3f}"
+                )
+                for s in sorted(self.stats(), key = lambda s: -s.self)
+            ],
+            headers = (
+                'Stage',
+                'Calls',
+                'Items',
+                'Total (s)',
+                'Self (s)',
+                'I/O (s)'
+            ),
+            tablefmt = 'psql'
+        )
+
+    def json(self):
+        """
+        Returns the statistics as a JSON string.
+        """
+        return json.dumps([s._asdict() for s in self.stats()], indent = 2)
+
+    def chrome_trace(self):
+        """
+        Returns the recorded events as a JSON string in the Chrome trace event
+        format, which can be loaded into ``chrome://tracing`` or Perfetto.
+        """
+        with self._lock:
+            events = list(self._events)
+        return json.dumps(dict(traceEvents = events))
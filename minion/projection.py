@@ -0,0 +1,285 @@
+"""
+Field projection for Minion plans.
+
+Sources such as ``issues`` return every field of every item, but templates
+usually only use a few of them. :func:`project` works out which fields of the
+items from each source are referenced by the expressions and templates that
+consume them, and passes them to the source as ``fields``. The source can
+then request a smaller representation from the API, if there is one, and
+drop the other fields as the items are parsed (see :mod:`minion.records`).
+
+A source supports projection if its :class:`~minion.core.MinionFunction` has
+a :class:`Projectable` as its ``projection`` attribute.
+
+The analysis is conservative. Starting from a source in a ``compose``, the
+following functions are examined in turn:
+
+* ``filter`` with an ``expression`` predicate, ``take`` and ``identity`` pass
+  the items on, so the analysis continues with the next function.
+* ``map`` and ``parallel_map`` with an ``expression`` or ``template``
+  function replace the items, so the analysis stops there.
+* Anything else could use any field, so the source is not projected.
+
+The source is also not projected if the items are passed on to another
+function outside the ``compose``, or if any expression or template uses the
+item as a whole rather than just its fields, e.g. ``input.get('title')`` or
+``input | tojson``.
+"""
+
+import collections
+import collections.abc
+import copy
+
+import jinja2
+from jinja2 import nodes
+from jinja2.parser import Parser
+
+from .core import import_path, MinionFunction
+from . import records, templating
+
+
+#: Describes how a source supports projection. ``attributes`` are the names
+#: of attributes of its items that are not plain fields, e.g. related
+#: resources, which cannot be projected. ``views`` maps a description of each
+#: smaller representation that the source can request to the set of fields
+#: that it contains.
+Projectable = collections.namedtuple(
+    'Projectable',
+    ['attributes', 'views'],
+    defaults = ((), None)
+)
+
+
+#: The projection for a single source. ``fields`` is ``None`` if the source
+#: could not be projected, and ``reason`` says why if the fields were not
+#: worked out by the analysis. ``view`` is the smaller representation that
+#: the source will request, if any.
+Projection = collections.namedtuple(
+    'Projection',
+    ['source', 'fields', 'view', 'reason']
+)
+
+
+_COMPOSE = 'minion.functions.compose'
+_PASS_THROUGH = {'minion.functions.take', 'minion.functions.identity'}
+_FILTERS = {'minion.functions.filter': 'predicate'}
+_MAPS = {
+    'minion.functions.map': 'function',
+    'minion.functions.parallel_map': 'function',
+}
+
+
+class _Unknown(Exception):
+    # Raised when the fields that are used cannot be determined
+    pass
+
+
+def _literal(spec):
+    # Compiled plans wrap parameter values in literal refs
+    if isinstance(spec, collections.abc.Mapping) and 'literalRef' in spec:
+        return spec['literalRef']
+    return spec
+
+
+def _path(spec):
+    # Returns the path of the function in the spec, if it is a function ref
+    if isinstance(spec, collections.abc.Mapping) and 'functionRef' in spec:
+        path = _literal(spec['functionRef'].get('path'))
+        if isinstance(path, str):
+            return path
+    return None
+
+
+def _walk(node, name, parents):
+    # Yields the fields of the variable that are used in the node
+    if isinstance(node, (nodes.Include, nodes.Import, nodes.FromImport,
+                         nodes.Extends)):
+        # Other templates can see the variable
+        raise _Unknown("the template includes another template")
+    if isinstance(node, nodes.Name) and node.name == name:
+        if node.ctx != 'load':
+            raise _Unknown(f"'{name}' is assigned to")
+        parent = parents[-1] if parents else None
+        grandparent = parents[-2] if len(parents) > 1 else None
+        if isinstance(parent, nodes.Getattr):
+            field = parent.attr
+        elif isinstance(parent, nodes.Getitem) and \
+             isinstance(parent.arg, nodes.Const) and \
+             isinstance(parent.arg.value, str):
+            field = parent.arg.value
+        else:
+            raise _Unknown(f"'{name}' is used as a whole")
+        if isinstance(grandparent, nodes.Call) and grandparent.node is parent:
+            raise _Unknown(f"'{name}.{field}' is called")
+        yield field
+        return
+    parents.append(node)
+    for child in node.iter_child_nodes():
+        yield from _walk(child, name, parents)
+    parents.pop()
+
+
+def referenced_fields(source, name = 'input', template = False):
+    """
+    Returns the set of fields of the variable with the given name that are
+    used in the given Jinja2 expression, or template if ``template`` is true.
+
+    Raises ``ValueError`` if the variable is used in any other way, e.g. as a
+    whole, so the fields that are needed cannot be determined.
+    """
+    environment = templating.environment
+    try:
+        if template:
+            node = environment.parse(source)
+        else:
+            parser = Parser(environment, source, state = 'variable')
+            node = parser.parse_expression()
+    except jinja2.TemplateSyntaxError as exc:
+        raise ValueError(f"invalid expression: {exc}")
+    try:
+        return set(_walk(node, name, []))
+    except _Unknown as exc:
+        raise ValueError(str(exc))
+
+
+def _template_fields(spec):
+    # Returns the fields used by a template, which may be structured
+    spec = _literal(spec)
+    if isinstance(spec, str):
+        return referenced_fields(spec, template = True)
+    elif isinstance(spec, collections.abc.Mapping):
+        fields = set()
+        for k, v in spec.items():
+            fields.update(_template_fields(k), _template_fields(v))
+        return fields
+    elif isinstance(spec, list):
+        return set().union(*(_template_fields(v) for v in spec))
+    return set()
+
+
+def _function_fields(spec):
+    # Returns the fields used by a function that is applied to each item
+    path = _path(spec)
+    if path == 'minion.functions.expression':
+        expression = _literal(spec['functionRef'].get('expression'))
+        if isinstance(expression, str):
+            return referenced_fields(expression)
+    elif path == 'minion.functions.template':
+        return _template_fields(spec['functionRef'].get('template'))
+    raise ValueError(f"items are passed to {path or 'a value'}")
+
+
+def _consumers(stages, nested):
+    # Returns the fields used by the stages that consume the items from a
+    # source, or raises ValueError if that cannot be determined
+    fields = set()
+    for stage in stages:
+        path = _path(stage)
+        if path in _PASS_THROUGH:
+            continue
+        elif path in _FILTERS:
+            predicate = stage['functionRef'].get(_FILTERS[path])
+            fields.update(_function_fields(predicate))
+        elif path in _MAPS:
+            function = stage['functionRef'].get(_MAPS[path])
+            fields.update(_function_fields(function))
+            return fields
+        else:
+            raise ValueError(f"items are passed to {path or 'a value'}")
+    if nested:
+        raise ValueError("items are returned from a nested compose")
+    return fields
+
+
+def _projectable(path):
+    # Returns the projection support for the function at the given path
+    try:
+        function = import_path(path)
+    except (ImportError, AttributeError, ValueError):
+        return None
+    if isinstance(function, MinionFunction):
+        return function.projection
+    return None
+
+
+def _view(projectable, fields):
+    # Returns the smallest view that contains all the fields, if any
+    views = [
+        (len(view_fields), description)
+        for description, view_fields in (projectable.views or {}).items()
+        if fields.issubset(view_fields)
+    ]
+    return min(views)[1] if views else None
+
+
+def _project(spec, nested, projections):
+    # Finds the sources in the spec that can be projected and sets their
+    # fields, modifying the spec in place. Only the root function is not
+    # nested, as the result of any other function is used by its parent.
+    if isinstance(spec, collections.abc.Mapping):
+        if 'literalRef' in spec:
+            return
+        if _path(spec) == _COMPOSE:
+            stages = _literal(spec['functionRef'].get('functions'))
+            if isinstance(stages, list):
+                for index, stage in enumerate(stages):
+                    path = _path(stage)
+                    projectable = _projectable(path) if path else None
+                    if projectable is not None:
+                        projections.append(_project_source(
+                            stage,
+                            path,
+                            projectable,
+                            stages[index + 1:],
+                            nested
+                        ))
+        if 'functionRef' in spec:
+            spec = spec['functionRef']
+        for value in spec.values():
+            _project(value, True, projections)
+    elif isinstance(spec, list):
+        for value in spec:
+            _project(value, True, projections)
+
+
+def _project_source(stage, path, projectable, stages, nested):
+    function_ref = stage['functionRef']
+    given = _literal(function_ref.get('fields'))
+    if given:
+        return Projection(path, given, None, "the fields are given explicitly")
+    try:
+        fields = _consumers(stages, nested)
+    except ValueError as exc:
+        return Projection(path, None, None, str(exc))
+    if not fields:
+        return Projection(path, None, None, "no fields are used")
+    blocked = sorted(
+        f for f in fields
+        if f in projectable.attributes or
+           f in records.RESERVED_FIELDS or
+           f.startswith('_') or
+           not f.isidentifier()
+    )
+    if blocked:
+        return Projection(
+            path,
+            None,
+            None,
+            f"{', '.join(blocked)} cannot be projected"
+        )
+    fields = sorted(fields)
+    function_ref['fields'] = fields
+    return Projection(path, fields, _view(projectable, set(fields)), None)
+
+
+def project(plan):
+    """
+    Returns a copy of the given :class:`~minion.core.Plan` in which every
+    source that can be projected is given the fields that are used, and a
+    list of :class:`Projection`\\ s, one for each source that supports
+    projection.
+    """
+    spec = copy.deepcopy(plan.spec)
+    projections = []
+    _project(spec, False, projections)
+    return plan._replace(spec = spec), projections
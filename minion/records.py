@@ -0,0 +1,287 @@
+"""
+Compact representations for large numbers of items, e.g. issues.
+
+Connector results are usually objects with a dictionary for each instance,
+which holds every field returned by the API. When only a few fields are
+needed, these can be replaced by:
+
+* :class:`Record`\\ s, which store only the given fields using ``__slots__``.
+* A :class:`RecordTable`, which stores only the given fields in a list for
+  each field, and can be iterated over any number of times without copying.
+
+In both cases the fields can be accessed as attributes or items, so they can
+be used in expressions and templates in the same way as the original items.
+Fields that were missing from the original item are missing from the record,
+and so are undefined in expressions.
+"""
+
+import collections.abc
+import functools
+import sys
+
+
+def _field_names(fields):
+    # Fields can be given as a list or a comma-separated string
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    names = []
+    for field in fields:
+        field = field.strip()
+        if not field.isidentifier():
+            raise ValueError(f"'{field}' is not a valid field name")
+        if field in RESERVED_FIELDS:
+            raise ValueError(f"'{field}' is reserved and cannot be a field")
+        if field not in names:
+            names.append(field)
+    return tuple(names)
+
+
+def _compact(value):
+    # Repeated strings, e.g. states and labels, are stored once
+    if isinstance(value, str):
+        return sys.intern(value)
+    elif isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return [sys.intern(v) for v in value]
+    return value
+
+
+def _hashable(value):
+    # Returns a hashable equivalent of a value, so that records with list
+    # fields, e.g. labels, can be hashed
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    elif isinstance(value, dict):
+        return frozenset((k, _hashable(v)) for k, v in value.items())
+    return value
+
+
+def _get(data, name):
+    # Gets a field from a dictionary or an object
+    if isinstance(data, collections.abc.Mapping):
+        return data[name]
+    try:
+        return getattr(data, name)
+    except AttributeError:
+        raise KeyError(name)
+
+
+class Record:
+    """
+    Base class for records, which store a fixed set of fields in slots.
+
+    Record classes are created using :func:`record_type`. Records can be
+    pickled, and are unpickled as an instance of the record class for the same
+    fields.
+    """
+    __slots__ = ()
+
+    #: The names of the fields of the record
+    _fields = ()
+
+    def __init__(self, **values):
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Returns a record containing the fields of the record type from the
+        given dictionary or object.
+        """
+        record = cls.__new__(cls)
+        for name in cls._fields:
+            try:
+                value = _get(data, name)
+            except KeyError:
+                continue
+            object.__setattr__(record, name, _compact(value))
+        return record
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except (AttributeError, TypeError):
+            raise KeyError(name)
+
+    def get(self, name, default = None):
+        """
+        Returns the value of the field with the given name, or ``default`` if
+        the record does not have the field.
+        """
+        return getattr(self, name, default)
+
+    def _asdict(self):
+        """
+        Returns the fields that the record has as a dictionary.
+        """
+        return {
+            name: getattr(self, name)
+            for name in self._fields
+            if hasattr(self, name)
+        }
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._asdict() == other._asdict()
+
+    def __hash__(self):
+        # Equal records have the same fields and values
+        return hash(frozenset(
+            (name, _hashable(value))
+            for name, value in self._asdict().items()
+        ))
+
+    def __repr__(self):
+        values = ', '.join(f"{k}={v!r}" for k, v in self._asdict().items())
+        return f"{type(self).__name__}({values})"
+
+    def __reduce__(self):
+        # Record classes are created at runtime, so they cannot be pickled by
+        # name and are re-created from their fields instead
+        return (_restore, (self._fields, self._asdict()))
+
+
+def _restore(fields, values):
+    # Used to unpickle records
+    return _record_type(fields)(**values)
+
+
+@functools.lru_cache(maxsize = None)
+def _record_type(fields):
+    return type('Record', (Record, ), dict(__slots__ = fields, _fields = fields))
+
+
+def record_type(fields):
+    """
+    Returns a subclass of :class:`Record` with the given fields, given as a
+    list or a comma-separated string. The same class is returned for the same
+    fields.
+
+    Raises ``ValueError`` if a field is not a valid identifier or is one of
+    the :data:`RESERVED_FIELDS`.
+    """
+    return _record_type(_field_names(fields))
+
+
+# Marks a field that was missing from an item in a table
+_MISSING = object()
+
+
+class Row:
+    """
+    View of a single row of a :class:`RecordTable`, which supports the same
+    operations as a :class:`Record`. Rows are created on demand, so they use
+    no memory while they are not being used.
+    """
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    @property
+    def _fields(self):
+        return self._table.fields
+
+    def __getattr__(self, name):
+        try:
+            value = self._table._columns[name][self._index]
+        except KeyError:
+            value = _MISSING
+        if value is _MISSING:
+            raise AttributeError(name)
+        return value
+
+    __getitem__ = Record.__getitem__
+    get = Record.get
+    _asdict = Record._asdict
+    __hash__ = Record.__hash__
+
+    def __eq__(self, other):
+        if not isinstance(other, Row):
+            return NotImplemented
+        return self._asdict() == other._asdict()
+
+    def __repr__(self):
+        values = ', '.join(f"{k}={v!r}" for k, v in self._asdict().items())
+        return f"Row({values})"
+
+
+#: Names that cannot be used as fields, as records and rows use them for
+#: their own attributes, e.g. ``get``
+RESERVED_FIELDS = frozenset(
+    name
+    for cls in (Record, Row)
+    for name in dir(cls)
+    if not name.startswith('__')
+)
+
+
+class RecordTable(collections.abc.Sequence):
+    """
+    Table that stores the given fields of a number of items in a list per
+    field, i.e. by column rather than by row.
+
+    Indexing or iterating over the table returns a :class:`Row` for each item.
+    As the table is a sequence, it can be iterated over any number of times,
+    so functions that need to do so, e.g. ``zip_matching``, use it without
+    copying it.
+    """
+    def __init__(self, fields, items = ()):
+        self.fields = _field_names(fields)
+        self._columns = { name: [] for name in self.fields }
+        self._length = 0
+        self.extend(items)
+
+    def append(self, item):
+        """
+        Adds the given fields from the given dictionary or object to the table.
+        """
+        for name, column in self._columns.items():
+            try:
+                value = _compact(_get(item, name))
+            except KeyError:
+                value = _MISSING
+            column.append(value)
+        self._length += 1
+
+    def extend(self, items):
+        """
+        Adds each of the given items to the table.
+        """
+        for item in items:
+            self.append(item)
+
+    def column(self, name):
+        """
+        Returns the values of the given field as a list, with ``None`` for any
+        items that did not have the field.
+        """
+        return [
+            None if value is _MISSING else value
+            for value in self._columns[name]
+        ]
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            table = RecordTable(self.fields)
+            for name, column in self._columns.items():
+                table._columns[name] = column[index]
+            table._length = len(range(*index.indices(self._length)))
+            return table
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("table index out of range")
+        return Row(self, index)
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield Row(self, index)
+
+    def __repr__(self):
+        return f"RecordTable({list(self.fields)!r}, {len(self)} rows)"
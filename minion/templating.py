@@ -0,0 +1,479 @@
+"""
+Shared Jinja2 environment used by Minion functions, with caching of compiled
+templates and expressions.
+
+Templates are loaded by source rather than by file, so compiled templates are
+content-addressed: identical templates and expressions anywhere in a process
+share a single compiled instance, kept in a bounded in-memory LRU cache. If a
+directory is configured using :func:`configure`, the compiled bytecode is
+also cached on disk so that it can be re-used by other processes.
+
+Simple expressions, i.e. those made only of variables, constants, attribute
+and item lookups, comparisons, boolean logic, tests and filters, are compiled
+directly into Python closures instead (see :func:`compile_native`), which
+avoids setting up a template context for each evaluation.
+"""
+
+import collections
+import functools
+import operator
+import os
+import pathlib
+import threading
+
+import jinja2
+from jinja2 import nodes
+from jinja2.environment import TemplateExpression
+from jinja2.parser import Parser
+
+
+#: The default number of compiled templates to keep in memory
+DEFAULT_CACHE_SIZE = 1000
+
+#: The default maximum number of files in the bytecode cache directory
+DEFAULT_MAX_FILES = 5000
+
+
+#: Statistics for the caches
+CacheStats = collections.namedtuple(
+    'CacheStats',
+    ['hits', 'misses', 'bytecode_hits', 'bytecode_misses']
+)
+
+
+class _Stats:
+    # Thread-safe counters for the cache statistics
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = collections.Counter()
+
+    def record(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self._counts)
+        lookups = counts.get('lookups', 0)
+        loads = counts.get('loads', 0)
+        return CacheStats(
+            lookups - loads,
+            loads,
+            counts.get('bytecode_hits', 0),
+            counts.get('bytecode_misses', 0)
+        )
+
+
+_stats = _Stats()
+
+
+class SourceLoader(jinja2.BaseLoader):
+    """
+    Jinja2 loader for which the name of a template is its source.
+    """
+    def get_source(self, environment, template):
+        # The source never changes for a given name
+        return template, None, lambda: True
+
+    def load(self, environment, name, globals = None):
+        _stats.record('loads')
+        return super().load(environment, name, globals)
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    Filesystem bytecode cache that records hits and misses, and keeps at most
+    ``max_files`` files by removing the least recently used ones.
+    """
+    def __init__(self, directory, max_files = DEFAULT_MAX_FILES):
+        super().__init__(str(directory))
+        self.max_files = max_files
+
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+        if bucket.code is None:
+            _stats.record('bytecode_misses')
+        else:
+            _stats.record('bytecode_hits')
+            # Mark the file as recently used for pruning
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+    def prune(self):
+        """
+        Removes the least recently used files until there are at most
+        ``max_files`` files.
+        """
+        paths = []
+        for path in pathlib.Path(self.directory).glob(self.pattern % '*'):
+            try:
+                paths.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                pass
+        paths.sort()
+        for _, path in paths[:max(len(paths) - self.max_files, 0)]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+environment = jinja2.Environment(
+    extensions = ['jinja2.ext.loopcontrols'],
+    loader = SourceLoader(),
+    cache_size = DEFAULT_CACHE_SIZE,
+    # Sources never change, so there is no need to check them
+    auto_reload = False
+)
+
+
+def configure(
+    directory = None,
+    cache_size = None,
+    max_files = DEFAULT_MAX_FILES
+):
+    """
+    Configures the caches for the shared environment.
+
+    If ``directory`` is given, compiled bytecode is cached in that directory,
+    which is pruned to at most ``max_files`` files. If ``cache_size`` is given,
+    it sets the number of compiled templates to keep in memory.
+    """
+    if directory is not None:
+        current = environment.bytecode_cache
+        if current is None or current.directory != str(directory):
+            directory.mkdir(parents = True, exist_ok = True)
+            cache = BytecodeCache(directory, max_files)
+            cache.prune()
+            environment.bytecode_cache = cache
+    if cache_size is not None:
+        environment.cache = jinja2.utils.LRUCache(cache_size)
+
+
+def get_template(source):
+    """
+    Returns the compiled template for the given source.
+    """
+    _stats.record('lookups')
+    return environment.get_template(source)
+
+
+_COMPARISONS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'gteq': operator.ge,
+    'lt': operator.lt,
+    'lteq': operator.le,
+    'in': lambda a, b: a in b,
+    'notin': lambda a, b: a not in b,
+}
+
+
+class _Unsupported(Exception):
+    # Raised when an expression cannot be compiled to a closure
+    pass
+
+
+# Attributes used by Jinja2 2.x to mark filters and tests that are passed a
+# context, evaluation context or environment
+_LEGACY_PASS_ARGS = (
+    'contextfilter',
+    'evalcontextfilter',
+    'environmentfilter',
+    'contextfunction',
+    'evalcontextfunction',
+    'environmentfunction',
+)
+
+
+def _resolve(variables, name):
+    # Resolves a name in the same way as a template context
+    try:
+        return variables[name]
+    except KeyError:
+        pass
+    try:
+        return environment.globals[name]
+    except KeyError:
+        return environment.undefined(name = name)
+
+
+def _compile_args(node):
+    # Compiles the positional arguments of a filter or test call, which may
+    # not use keyword or dynamic arguments
+    if node.kwargs or node.dyn_args or node.dyn_kwargs:
+        raise _Unsupported()
+    return [_compile_node(arg) for arg in node.args]
+
+
+def _compile_call(node, functions, call):
+    function = functions.get(node.name)
+    if function is None:
+        # Let Jinja2 report the unknown filter or test
+        raise _Unsupported()
+    # Functions that need the template context can only be called by a
+    # template
+    pass_arg = getattr(function, 'jinja_pass_arg', None)
+    if getattr(pass_arg, 'name', None) == 'context':
+        raise _Unsupported()
+    # Jinja2 2.x marks functions that are passed a context or environment
+    # with attributes instead, so leave those to a template as well
+    if any(getattr(function, attr, False) for attr in _LEGACY_PASS_ARGS):
+        raise _Unsupported()
+    value = _compile_node(node.node)
+    args = _compile_args(node)
+    name = node.name
+    return lambda v: call(name, value(v), [arg(v) for arg in args])
+
+
+def _compile_node(node):
+    # Returns a function that evaluates the node given a dict of variables,
+    # with the same semantics as the code generated by Jinja2
+    if isinstance(node, nodes.Const):
+        value = node.value
+        return lambda v: value
+    elif isinstance(node, nodes.Name) and node.ctx == 'load':
+        name = node.name
+        return lambda v: _resolve(v, name)
+    elif isinstance(node, nodes.Getattr):
+        obj = _compile_node(node.node)
+        attr = node.attr
+        return lambda v: environment.getattr(obj(v), attr)
+    elif isinstance(node, nodes.Getitem) and \
+         not isinstance(node.arg, nodes.Slice):
+        obj = _compile_node(node.node)
+        arg = _compile_node(node.arg)
+        return lambda v: environment.getitem(obj(v), arg(v))
+    elif isinstance(node, nodes.Compare):
+        first = _compile_node(node.expr)
+        ops = [(_COMPARISONS[op.op], _compile_node(op.expr)) for op in node.ops]
+        if len(ops) == 1:
+            (op, second), = ops
+            return lambda v: op(first(v), second(v))
+        def compare(v):
+            # Chained comparisons, as in Python
+            left = first(v)
+            for op, expr in ops:
+                right = expr(v)
+                result = op(left, right)
+                if not result:
+                    return result
+                left = right
+            return result
+        return compare
+    elif isinstance(node, nodes.And):
+        left, right = _compile_node(node.left), _compile_node(node.right)
+        return lambda v: left(v) and right(v)
+    elif isinstance(node, nodes.Or):
+        left, right = _compile_node(node.left), _compile_node(node.right)
+        return lambda v: left(v) or right(v)
+    elif isinstance(node, nodes.Not):
+        operand = _compile_node(node.node)
+        return lambda v: not operand(v)
+    elif isinstance(node, nodes.CondExpr):
+        test = _compile_node(node.test)
+        expr1 = _compile_node(node.expr1)
+        if node.expr2 is None:
+            expr2 = lambda v: environment.undefined(
+                "the inline if-expression evaluated to false and no else "
+                "section was defined."
+            )
+        else:
+            expr2 = _compile_node(node.expr2)
+        return lambda v: expr1(v) if test(v) else expr2(v)
+    elif isinstance(node, (nodes.List, nodes.Tuple)):
+        items = [_compile_node(item) for item in node.items]
+        kind = list if isinstance(node, nodes.List) else tuple
+        return lambda v: kind(item(v) for item in items)
+    elif isinstance(node, nodes.Test):
+        return _compile_call(node, environment.tests, environment.call_test)
+    elif isinstance(node, nodes.Filter) and node.node is not None:
+        return _compile_call(
+            node,
+            environment.filters,
+            environment.call_filter
+        )
+    raise _Unsupported()
+
+
+class NativeExpression:
+    """
+    Expression compiled into a Python closure by :func:`compile_native`.
+
+    It is called in the same way as :class:`jinja2.environment.TemplateExpression`
+    and produces the same results.
+    """
+    def __init__(self, source, evaluate, undefined_to_none = True):
+        self.source = source
+        self._evaluate = evaluate
+        self._undefined_to_none = undefined_to_none
+
+    def evaluate(self, variables):
+        """
+        Evaluates the expression with the given dictionary of variables.
+        """
+        result = self._evaluate(variables)
+        if self._undefined_to_none and isinstance(result, jinja2.Undefined):
+            return None
+        return result
+
+    def __call__(self, *args, **kwargs):
+        return self.evaluate(dict(*args, **kwargs))
+
+
+@functools.lru_cache(maxsize = DEFAULT_CACHE_SIZE)
+def _parse_expression(source):
+    # Parses a single expression, raising TemplateSyntaxError if the source
+    # is anything else, as for jinja2.Environment.compile_expression
+    parser = Parser(environment, source, state = 'variable')
+    node = parser.parse_expression()
+    if not parser.stream.eos:
+        raise jinja2.TemplateSyntaxError(
+            "chunk after expression",
+            parser.stream.current.lineno,
+            None,
+            None
+        )
+    return node
+
+
+def _expression_template(source, template, *path):
+    # Returns the compiled template for the given source, in which the
+    # expression has been substituted. To make sure that the expression
+    # cannot change the rest of the template, it must be a single expression
+    # and must parse to the same node in the template, found at the given
+    # path of attributes and indices.
+    expected = _parse_expression(source)
+    node = environment.parse(template)
+    try:
+        for step in path:
+            node = node[step] if isinstance(step, int) else getattr(node, step)
+    except (AttributeError, IndexError):
+        node = None
+    if node != expected:
+        raise jinja2.TemplateSyntaxError(
+            f"'{source}' is not a valid expression",
+            1,
+            None,
+            None
+        )
+    return get_template(template)
+
+
+@functools.lru_cache(maxsize = DEFAULT_CACHE_SIZE)
+def _compile_native(source):
+    try:
+        return _compile_node(_parse_expression(source))
+    except (_Unsupported, jinja2.TemplateSyntaxError):
+        # Leave Jinja2 to report any syntax errors
+        return None
+
+
+def compile_native(source, undefined_to_none = True):
+    """
+    Compiles the given expression into a :class:`NativeExpression` if it is
+    simple enough, otherwise returns ``None``.
+    """
+    evaluate = _compile_native(source)
+    if evaluate is None:
+        return None
+    return NativeExpression(source, evaluate, undefined_to_none)
+
+
+def compile_expression(source, undefined_to_none = True):
+    """
+    Returns a callable that evaluates the given expression, as for
+    :meth:`jinja2.Environment.compile_expression`.
+
+    Simple expressions are compiled into a :class:`NativeExpression`.
+    """
+    native = compile_native(source, undefined_to_none)
+    if native is not None:
+        return native
+    template = _expression_template(
+        source,
+        f"{{% set result = {source} %}}",
+        'body', 0, 'node'
+    )
+    return TemplateExpression(template, undefined_to_none)
+
+
+def _collect(values, value):
+    # Used by batch templates to collect the value of each evaluation
+    values.append(None if isinstance(value, jinja2.Undefined) else value)
+    return ''
+
+
+def _uses_loop_names(source):
+    # Returns true if the expression refers to the loop variable or to any of
+    # the private variables that are used by the batch template
+    try:
+        node = _parse_expression(source)
+    except jinja2.TemplateSyntaxError:
+        # Leave Jinja2 to report the error when compiling the template
+        return False
+    return any(
+        n.name == 'loop' or n.name.startswith('__')
+        for n in node.find_all(nodes.Name)
+    )
+
+
+def compile_batch_expression(source, name):
+    """
+    Returns a function that evaluates the given expression for each of a list
+    of values, which are bound to ``name``, and returns a list of the
+    results. It also accepts keyword arguments for any other variables.
+
+    Simple expressions are evaluated using a :class:`NativeExpression`.
+    Otherwise a single template is rendered for the whole list, rather than
+    one for each value, unless the expression uses names that would resolve
+    differently inside the loop of that template. Undefined results are
+    returned as ``None``.
+    """
+    native = compile_native(source)
+    if native is not None:
+        evaluate_one = native.evaluate
+    elif _uses_loop_names(source):
+        # Evaluate the expression for each value, as compile_expression would
+        evaluate_one = compile_expression(source)
+    else:
+        evaluate_one = None
+    if evaluate_one is not None:
+        def evaluate(values, **variables):
+            results = []
+            for value in values:
+                variables[name] = value
+                results.append(evaluate_one(variables))
+            return results
+        return evaluate
+    template = _expression_template(
+        source,
+        f"{{% for {name} in __values %}}"
+        f"{{{{ __collect(__results, ({source})) }}}}"
+        "{% endfor %}",
+        'body', 0, 'body', 0, 'nodes', 0, 'args', 1
+    )
+    def evaluate(values, **variables):
+        results = []
+        template.render(
+            __collect = _collect,
+            __values = values,
+            __results = results,
+            **variables
+        )
+        return results
+    return evaluate
+
+
+def stats():
+    """
+    Returns the statistics for the caches as a :class:`CacheStats`.
+    """
+    return _stats.snapshot()
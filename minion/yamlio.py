@@ -0,0 +1,90 @@
+"""
+Central YAML input and output for Minion.
+
+Uses the libyaml-based ``CSafeLoader`` and ``CSafeDumper`` when PyYAML has
+been built with libyaml, falling back to the pure-Python implementations if
+not. Only the safe loader and dumper are ever used.
+
+Functions that parse text produced at runtime, such as
+:func:`minion.functions.template`, look up their parser by name using
+:func:`parser`, so that faster backends can be selected or registered.
+"""
+
+import json
+
+import yaml
+
+
+try:
+    Loader = yaml.CSafeLoader
+    Dumper = yaml.CSafeDumper
+except AttributeError:
+    Loader = yaml.SafeLoader
+    Dumper = yaml.SafeDumper
+
+
+def load(stream):
+    """
+    Parses the first YAML document in the given string or file.
+    """
+    return yaml.load(stream, Loader = Loader)
+
+
+def dump(data, stream = None, **kwargs):
+    """
+    Serialises the given data as YAML to the given file, or returns it as a
+    string if no file is given.
+    """
+    return yaml.dump(data, stream, Dumper = Dumper, **kwargs)
+
+
+# Used to type plain scalars in the same way as the loader
+_resolver = yaml.resolver.Resolver()
+_constructor = yaml.constructor.SafeConstructor()
+
+
+def scalar(text):
+    """
+    Returns the value of the given text as a plain YAML scalar, i.e. the
+    value it would have if it appeared unquoted in a YAML document. For
+    example, ``'1'`` gives an integer, ``'yes'`` a boolean and ``''`` gives
+    ``None``. Text that is a string is returned without any surrounding
+    whitespace.
+    """
+    # Surrounding whitespace is not part of a plain scalar
+    text = text.strip()
+    tag = _resolver.resolve(yaml.ScalarNode, text, (True, False))
+    # Tags like merge ('<<') and value ('=') have no constructor, so are
+    # treated as strings
+    if tag == _resolver.DEFAULT_SCALAR_TAG or \
+            tag not in _constructor.yaml_constructors:
+        return text
+    node = yaml.ScalarNode(tag, text)
+    return _constructor.yaml_constructors[tag](_constructor, node)
+
+
+# Parsers indexed by backend name
+_parsers = {
+    'yaml': load,
+    # JSON is a subset of YAML, so templates that render JSON can use the
+    # much faster JSON parser
+    'json': json.loads,
+}
+
+
+def register_parser(name, function):
+    """
+    Registers a parser backend with the given name. ``function`` should take
+    a string and return the parsed data.
+    """
+    _parsers[name] = function
+
+
+def parser(name = 'yaml'):
+    """
+    Returns the parser backend with the given name.
+    """
+    try:
+        return _parsers[name]
+    except KeyError:
+        raise LookupError(f"Parser '{name}' does not exist")